@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+
+# Benchmarks of the storage and the commands on a generated ledger.
+#
+#   ./bench.py [--years N] [--per-day N] [--output FILE] [--compare FILE]
+#   ./bench.py --startup-only [--startup-budget MS]
+#
+# Results are written as json so that runs on different commits can be
+# compared with --compare. The startup check also runs the cs script for
+# a few commands and fails when one of them imports a module it doesn't
+# need, or when its best run takes longer than the startup budget.
+# --startup-only runs that check alone.
+
+from csbook import CSBook
+from storage import Storage
+from record import Record
+from cmd_view import ViewCommand
+
+import argparse, contextlib, datetime, json, os, platform, random, shutil
+import subprocess, sys, tempfile, time
+
+# Write a ledger through Storage.insert(), ending now so that relative
+# ranges like "1y" find records. The same arguments give the same ledger.
+def generateLedger(path, years = 1, perDay = 10, editRatio = 0.05,
+                   deleteRatio = 0.02, types = 20, tags = 50,
+                   payments = 5, seed = 1):
+    rnd = random.Random(seed)
+    storage = Storage(path)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    start = now - datetime.timedelta(days = int(365 * years))
+    typeNames = ["type{}".format(i) for i in range(types)]
+    tagNames = ["tag{}".format(i) for i in range(tags)]
+    paymentNames = ["payment{}".format(i) for i in range(payments)]
+    recs = []
+    # one write per block instead of one per record.
+    with storage.groupCommit():
+        for day in range(int(365 * years)):
+            for i in range(perDay):
+                date = start + datetime.timedelta(
+                    days = day, seconds = rnd.randint(0, 86399))
+                rec = Record.createFromDictionary({
+                    "date": date,
+                    "summary": "{} {} 午餐".format(
+                        rnd.choice(["lunch", "bus", "book", "rent"]),
+                        rnd.randint(0, 999)),
+                    "type": rnd.choice(typeNames),
+                    "tags": rnd.sample(tagNames, rnd.randint(0, 3)),
+                    "amount": rnd.randint(1, 100000) / 100,
+                    "payment": rnd.choice(paymentNames),
+                    "currency": "NTD"
+                }, storage)
+                rec.store()
+                recs.append(rec)
+        for rec in rnd.sample(recs, int(len(recs) * editRatio)):
+            rec.amount(rnd.randint(1, 100000) / 100)
+            rec.store()
+        for rec in rnd.sample(recs, int(len(recs) * deleteRatio)):
+            rec.delete()
+    return [r.rId() for r in recs if not r.deleted()]
+
+# best and median wall time of |repeat| runs of |func|. |setup| runs
+# before each of them, untimed, and its result is passed to |func|.
+def measure(func, repeat, setup = None):
+    times = []
+    for i in range(repeat):
+        arg = setup() if setup != None else None
+        t = time.perf_counter()
+        func(arg) if setup != None else func()
+        times.append(time.perf_counter() - t)
+    times.sort()
+    return { "best": times[0], "median": times[len(times) // 2],
+             "runs": len(times) }
+
+# a copy of the ledger in |path|, next to it, with every block archived;
+# made by the first scenario that needs it and removed by main().
+def archivedCopy(path):
+    return path + "-archived"
+
+def scenarios(path, ids, rnd):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    def ago(days):
+        return now - datetime.timedelta(days = days)
+    def storage():
+        return Storage(path)
+    def coldStorage():
+        shutil.rmtree(os.path.join(path, "cache"), ignore_errors = True)
+        return Storage(path)
+    archived = archivedCopy(path)
+    def archivedColdStorage():
+        if not os.path.isdir(archived):
+            shutil.copytree(path, archived)
+            Storage(archived).archive(now)
+        shutil.rmtree(os.path.join(archived, "cache"), ignore_errors = True)
+        return Storage(archived)
+    def withoutIndexes():
+        for fn in ["vocabulary.json", "ids.json"]:
+            if os.path.isfile(os.path.join(path, fn)):
+                os.remove(os.path.join(path, fn))
+        return Storage(path)
+    def withoutSearchIndex():
+        cache = os.path.join(path, "cache")
+        for fn in os.listdir(cache):
+            if fn.endswith(".search"):
+                os.remove(os.path.join(cache, fn))
+        return Storage(path)
+    def view(args):
+        def run(s):
+            with open(os.devnull, "w") as f, contextlib.redirect_stdout(f):
+                ViewCommand(CSBook(s)).run(args)
+        return run
+    def makeRecord(s, recId = None):
+        dic = { "date": now, "summary": "bench", "type": "type0",
+                "tags": ["tag0"], "amount": 1.0, "payment": "payment0",
+                "currency": "NTD" }
+        if recId != None:
+            dic["id"] = recId
+        return CSBook(s).makeRecord(dic)
+    # 100 records in the same second, which needs unique ids.
+    def storeMany(s):
+        book = CSBook(s)
+        allocator = book.idAllocator()
+        book.storeMany([makeRecord(s, allocator.allocate(now))
+                        for i in range(100)])
+    def edit(s):
+        rec = s.findById(rnd.choice(ids))
+        rec.amount(rec.amount() + 1)
+        rec.store()
+    def remove(s):
+        rec = s.findById(ids.pop(rnd.randrange(len(ids))))
+        rec.delete()
+    # 100 ids, resolved a block at a time and deleted with an append per
+    # block, like cs rm <id>...
+    def removeMany(s):
+        batch = [ids.pop(rnd.randrange(len(ids))) for i in range(100)]
+        with s.groupCommit():
+            for rec in s.findByIds(batch).values():
+                rec.delete()
+
+    return [
+        ("list_3d", storage, lambda s: s.list(ago(3), now)),
+        ("list_30d", storage, lambda s: s.list(ago(30), now)),
+        ("list_1y", storage, lambda s: s.list(ago(365), now)),
+        ("list_all", storage, lambda s: s.list(ago(365 * 100), now)),
+        ("list_all_cold_cache", coldStorage,
+         lambda s: s.list(ago(365 * 100), now)),
+        ("list_all_cold_archived", archivedColdStorage,
+         lambda s: s.list(ago(365 * 100), now)),
+        ("list_1y_2_processes",
+         lambda: Storage(path, workers = 2, pool = "process"),
+         lambda s: s.list(ago(365), now)),
+        ("list_1y_2_threads",
+         lambda: Storage(path, workers = 2, pool = "thread"),
+         lambda s: s.list(ago(365), now)),
+        ("iter_range_1y", storage,
+         lambda s: sum(1 for r in s.iterRange(ago(365), now))),
+        ("iter_range_6h", storage,
+         lambda s: sum(1 for r in s.iterRange(ago(0.25), now))),
+        ("find_by_id", storage, lambda s: s.findById(rnd.choice(ids))),
+        ("find_by_ids_100", storage,
+         lambda s: s.findByIds(rnd.sample(ids, 100))),
+        ("collect_all", storage,
+         lambda s: (s.allType(), s.allTag(), s.allPayment())),
+        ("collect_all_rebuild", withoutIndexes,
+         lambda s: (s.allType(), s.allTag(), s.allPayment())),
+        ("report_month", storage,
+         lambda s: s.columns(ago(365 * 100), now).groupBy(["month"])),
+        ("report_month_tag", storage,
+         lambda s: s.columns(ago(365 * 100), now).groupBy(["month", "tag"])),
+        ("search", storage, lambda s: s.search("lunch 123")),
+        ("search_cjk", storage, lambda s: s.search("bus 午餐")),
+        ("search_rebuild", withoutSearchIndex,
+         lambda s: s.search("lunch 123")),
+        ("view_1d", storage, view(["1d"])),
+        ("view_30d", storage, view(["30d"])),
+        ("view_1y", storage, view(["1y"])),
+        ("view_1y_summary", storage, view(["1y", "--summary"])),
+        ("view_1y_tag_payment", storage,
+         view(["1y", "--tag", "tag1", "--payment", "payment0"])),
+        ("filtered_1y_type", storage,
+         lambda s: sum(1 for r in s.iterFiltered(ago(365), now,
+                                                 { "type": ["type0"] }))),
+        ("add", storage, lambda s: makeRecord(s).store()),
+        ("add_100_batched", storage, storeMany),
+        ("edit", storage, edit),
+        ("rm", storage, remove),
+        ("rm_100_batched", storage, removeMany),
+    ]
+
+# Modules that a command must not import: they are only needed by other
+# commands, or only in rare cases (dateutil.parser for dates that aren't
+# in isoformat, concurrent.futures for parallel loading).
+STARTUP_FORBIDDEN = {
+    ("rm", "unknown-id"): { "dateutil.parser", "dateutil.tz", "readline",
+                            "unicodedata", "calendar",
+                            "concurrent.futures" },
+    ("view", "30d"): { "dateutil.parser", "readline",
+                       "concurrent.futures" },
+    ("view", "1y", "--summary"): { "dateutil.parser", "readline",
+                                   "concurrent.futures" },
+    ("compact",): { "dateutil.parser", "dateutil.tz", "readline",
+                    "unicodedata", "calendar", "concurrent.futures" },
+    ("add",): { "dateutil.parser", "unicodedata", "calendar",
+                "concurrent.futures" },
+}
+
+# Run by the startup check: runs cs and reports the imported modules.
+STARTUP_SCRIPT = """
+import atexit, json, os, runpy, sys
+atexit.register(lambda: sys.stderr.write(
+    "\\nMODULES " + json.dumps(sorted(sys.modules)) + "\\n"))
+sys.argv = sys.argv[1:]
+sys.path.insert(0, os.path.dirname(sys.argv[0]))
+runpy.run_path(sys.argv[0], run_name = "__main__")
+"""
+
+# Time |repeat| cold starts of cs for each command in STARTUP_FORBIDDEN
+# against the ledger in |path|, and check the modules it imports and that
+# the best run is within |budget| seconds: the first run of a command may
+# still have work to do, e.g. compact.
+# Returns the results and the list of failures.
+def startupChecks(path, repeat, budget):
+    home = tempfile.mkdtemp(prefix = "cs-bench-home-")
+    os.symlink(os.path.abspath(path), os.path.join(home, "cs"))
+    env = dict(os.environ, HOME = home)
+    env.pop("CS_PROFILE", None)
+    cs = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cs")
+    results = dict()
+    failures = []
+    try:
+        for args, forbidden in STARTUP_FORBIDDEN.items():
+            times = []
+            for i in range(repeat):
+                t = time.perf_counter()
+                proc = subprocess.run(
+                    [sys.executable, "-c", STARTUP_SCRIPT, cs] + list(args),
+                    env = env, stdin = subprocess.DEVNULL,
+                    stdout = subprocess.DEVNULL, stderr = subprocess.PIPE)
+                times.append(time.perf_counter() - t)
+            line = proc.stderr.decode().strip().split("\n")[-1]
+            modules = set(json.loads(line[len("MODULES "):]))
+            name = "startup_" + "_".join(a.strip("-") for a in args)
+            times.sort()
+            results[name] = { "best": times[0],
+                              "median": times[len(times) // 2],
+                              "runs": len(times),
+                              "modules": len(modules) }
+            bad = sorted(forbidden & modules)
+            if len(bad) > 0:
+                failures.append("cs {} imports {}".format(" ".join(args),
+                                                          ", ".join(bad)))
+            if results[name]["best"] > budget:
+                failures.append("cs {} takes {:.0f}ms, over {:.0f}ms".format(
+                    " ".join(args), results[name]["best"] * 1000,
+                    budget * 1000))
+    finally:
+        shutil.rmtree(home, ignore_errors = True)
+    return results, failures
+
+def gitRevision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd = os.path.dirname(os.path.abspath(__file__)),
+            stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(old, new):
+    print("{:24} {:>10} {:>10} {:>7}".format("scenario", "old", "new", "ratio"))
+    for name, result in new["results"].items():
+        if not name in old["results"]:
+            continue
+        a = old["results"][name]["best"]
+        b = result["best"]
+        print("{:24} {:9.2f}ms {:9.2f}ms {:6.2f}x".format(
+            name, a * 1000, b * 1000, b / a if a > 0 else 0))
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description = "Benchmark cs on a generated ledger.")
+    parser.add_argument("--years", type = float, default = 1)
+    parser.add_argument("--per-day", type = int, default = 10)
+    parser.add_argument("--edit-ratio", type = float, default = 0.05)
+    parser.add_argument("--delete-ratio", type = float, default = 0.02)
+    parser.add_argument("--types", type = int, default = 20)
+    parser.add_argument("--tags", type = int, default = 50)
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--repeat", type = int, default = 5)
+    parser.add_argument("--only", action = "append",
+                        help = "run only the given scenario, can be repeated")
+    parser.add_argument("--ledger",
+                        help = "generate the ledger in this new directory "
+                               "and keep it")
+    parser.add_argument("--output", default = "bench_results.json")
+    parser.add_argument("--compare", help = "results of an earlier run")
+    parser.add_argument("--startup-only", action = "store_true",
+                        help = "run only the startup check")
+    parser.add_argument("--startup-budget", type = float, default = 300,
+                        help = "the longest best cold start of a command "
+                               "in ms")
+    args = parser.parse_args(argv)
+
+    params = { "years": args.years, "per_day": args.per_day,
+               "edit_ratio": args.edit_ratio,
+               "delete_ratio": args.delete_ratio, "types": args.types,
+               "tags": args.tags, "seed": args.seed }
+    tmp = None
+    path = args.ledger
+    if path == None:
+        tmp = tempfile.mkdtemp(prefix = "cs-bench-")
+        path = os.path.join(tmp, "ledger")
+    elif os.path.exists(path):
+        raise Exception("{} exists already".format(path))
+    try:
+        t = time.perf_counter()
+        ids = generateLedger(path, args.years, args.per_day,
+                             args.edit_ratio, args.delete_ratio,
+                             args.types, args.tags, seed = args.seed)
+        print("generated {} records in {:.1f}s".format(
+            len(ids), time.perf_counter() - t))
+        rnd = random.Random(args.seed)
+        results = dict()
+        for name, setup, func in scenarios(path, ids, rnd):
+            if args.startup_only or \
+               (args.only != None and not name in args.only):
+                continue
+            results[name] = measure(func, args.repeat, setup)
+            print("{:24} {:9.2f}ms".format(name,
+                                           results[name]["best"] * 1000))
+        startup, failures = startupChecks(path, args.repeat,
+                                          args.startup_budget / 1000)
+        for name, result in startup.items():
+            print("{:24} {:9.2f}ms".format(name, result["best"] * 1000))
+        results.update(startup)
+    finally:
+        shutil.rmtree(archivedCopy(path), ignore_errors = True)
+        if tmp != None:
+            shutil.rmtree(tmp, ignore_errors = True)
+
+    out = { "revision": gitRevision(),
+            "python": platform.python_version(),
+            "date": datetime.datetime.now().isoformat(),
+            "params": params,
+            "results": results }
+    with open(args.output, "w") as f:
+        json.dump(out, f, indent = 2)
+    if args.compare != None:
+        with open(args.compare, "r") as f:
+            compare(json.load(f), out)
+    for failure in failures:
+        print("startup check failed: " + failure, file = sys.stderr)
+    if len(failures) > 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
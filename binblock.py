@@ -0,0 +1,159 @@
+from record import toMicroseconds
+import mmap, struct, sys, bisect
+from array import array
+
+# Binary block format. A block is stored column by column so that a range
+# query can binary search the timestamps and decode only the rows it
+# needs. All numbers are little endian.
+#
+#   header    magic, rows, dictionary size, tag codes, heap size
+#   epoch     int64[rows]      microseconds since 1970, sorted
+#   amount    float64[rows]
+#   type      uint32[rows]     dictionary codes
+#   payment   uint32[rows]
+#   currency  uint32[rows]
+#   tagStart  uint32[rows+1]   range of each row in tagCode
+#   tagCode   uint32[tags]
+#   id        uint32[rows*2]   (offset, length) in heap
+#   summary   uint32[rows*2]
+#   dict      uint32[dict*2]
+#   heap      utf-8 strings
+#
+# Only live records are stored; later changes to the block are appended to
+# the jsonl file of the same block and replayed on top.
+
+MAGIC = b"CSBIN001"
+HEADER = struct.Struct("<8sIIII")
+
+def _pack(typecode, values):
+    a = array(typecode, values)
+    if sys.byteorder != "little":
+        a.byteswap()
+    return a.tobytes()
+
+def writeBlock(path, recs):
+    recs = sorted(recs, key = lambda r: r.date())
+    heap = bytearray()
+    strings = dict() # str -> (offset, length) in heap
+    def ref(s):
+        if not s in strings:
+            b = s.encode("utf-8")
+            strings[s] = (len(heap), len(b))
+            heap.extend(b)
+        return strings[s]
+    codes = dict() # str -> dictionary code
+    def code(s):
+        if not s in codes:
+            codes[s] = len(codes)
+        return codes[s]
+
+    tagStart = [0]
+    tagCode = []
+    for r in recs:
+        tagCode.extend(code(t) for t in r.tags())
+        tagStart.append(len(tagCode))
+    types = [code(r.typ()) for r in recs]
+    payments = [code(r.paymentMethod()) for r in recs]
+    currencies = [code(r.currency()) for r in recs]
+    ids = [v for r in recs for v in ref(r.rId())]
+    summaries = [v for r in recs for v in ref(r.summary())]
+    dictionary = [None] * len(codes)
+    for s, c in codes.items():
+        dictionary[c] = s
+    dictRefs = [v for s in dictionary for v in ref(s)]
+
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(recs), len(dictionary),
+                            len(tagCode), len(heap)))
+        f.write(_pack("q", [toMicroseconds(r.date()) for r in recs]))
+        f.write(_pack("d", [r.amount() for r in recs]))
+        f.write(_pack("I", types))
+        f.write(_pack("I", payments))
+        f.write(_pack("I", currencies))
+        f.write(_pack("I", tagStart))
+        f.write(_pack("I", tagCode))
+        f.write(_pack("I", ids))
+        f.write(_pack("I", summaries))
+        f.write(_pack("I", dictRefs))
+        f.write(heap)
+
+class BinaryBlock:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        magic, self._rows, ndict, ntags, nheap = \
+            HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise Exception("{} is not a binary block".format(path))
+        self._view = memoryview(self._mm)
+        self._offset = HEADER.size
+        n = self._rows
+        self._epoch = self._column("q", 8, n)
+        self._amount = self._column("d", 8, n)
+        self._type = self._column("I", 4, n)
+        self._payment = self._column("I", 4, n)
+        self._currency = self._column("I", 4, n)
+        self._tagStart = self._column("I", 4, n + 1)
+        self._tagCode = self._column("I", 4, ntags)
+        self._id = self._column("I", 4, n * 2)
+        self._summary = self._column("I", 4, n * 2)
+        dictRefs = self._column("I", 4, ndict * 2)
+        self._heap = self._offset
+        self._dict = [sys.intern(self._string(dictRefs, i))
+                      for i in range(ndict)]
+
+    # view of the next |count| items of |typecode| in the file.
+    def _column(self, typecode, size, count):
+        data = self._view[self._offset:self._offset + size * count]
+        self._offset = self._offset + size * count
+        if sys.byteorder == "little":
+            return data.cast(typecode)
+        a = array(typecode, data)
+        a.byteswap()
+        return a
+
+    def _string(self, refs, i):
+        start = self._heap + refs[i * 2]
+        return str(self._mm[start:start + refs[i * 2 + 1]], "utf-8")
+
+    def __len__(self):
+        return self._rows
+
+    # rows whose date is within [start_date, end_date].
+    def rowRange(self, start_date = None, end_date = None):
+        lo = 0 if start_date == None else \
+            bisect.bisect_left(self._epoch, toMicroseconds(start_date))
+        hi = self._rows if end_date == None else \
+            bisect.bisect_right(self._epoch, toMicroseconds(end_date))
+        return range(lo, max(lo, hi))
+
+    # decode |rows|, or the rows within the date range, column by column
+    # into record tuples.
+    def tuples(self, start_date = None, end_date = None, rows = None):
+        rows = rows if rows != None else self.rowRange(start_date, end_date)
+        lo, hi = rows.start, rows.stop
+        mm, heap, names = self._mm, self._heap, self._dict
+        def strings(refs):
+            refs = refs[lo * 2:hi * 2].tolist()
+            return [str(mm[heap + refs[i]:heap + refs[i] + refs[i + 1]],
+                        "utf-8")
+                    for i in range(0, len(refs), 2)]
+        tagStart = self._tagStart[lo:hi + 1].tolist()
+        tagCode = self._tagCode[tagStart[0]:tagStart[-1]].tolist() \
+            if hi > lo else []
+        base = tagStart[0]
+        out = []
+        for i, rId, us, summary, typ, amount, currency, payment in zip(
+                range(hi - lo),
+                strings(self._id),
+                self._epoch[lo:hi].tolist(),
+                strings(self._summary),
+                self._type[lo:hi].tolist(),
+                self._amount[lo:hi].tolist(),
+                self._currency[lo:hi].tolist(),
+                self._payment[lo:hi].tolist()):
+            tags = tuple(names[t] for t in
+                         tagCode[tagStart[i] - base:tagStart[i + 1] - base])
+            out.append((rId, us, summary, names[typ], tags, amount,
+                        names[currency], names[payment], False))
+        return out
@@ -0,0 +1,212 @@
+from record import Record
+import instrument
+import os, marshal, sys
+
+# Persistent cache of the decoded content of jsonl blocks. Blocks are only
+# appended to, so for each file the cache keeps the records decoded so far
+# together with the size, mtime and byte offset they were decoded up to.
+# As long as the bytes just before that offset are unchanged, the entry is
+# used as is, or, when the file has grown, only the lines after the offset
+# are decoded. Any other change throws the entry away.
+#
+# The content is the latest version of every id seen in the file,
+# tombstones included, so it can be replayed on top of other records the
+# same way as the lines it came from.
+CACHE_VERSION = 1
+TAIL = 64
+# bytes of an archived block decompressed at a time.
+COMPRESSED_CHUNK = 1 << 20
+
+# The cache of the blocks of |storage|, see above. With |memory|, entries
+# are also kept in memory, so that a long running process doesn't read the
+# cache files again.
+class BlockCache:
+    def __init__(self, storage, dirname = "cache", memory = False):
+        self._storage = storage
+        self._dir = storage.pathname(dirname)
+        self._entries = dict() if memory else None
+
+    def _cachePath(self, fn):
+        return os.path.join(self._dir, os.path.basename(fn) + ".cache")
+
+    def _read(self, fn):
+        if self._entries != None and fn in self._entries:
+            return self._entries[fn]
+        try:
+            with open(self._cachePath(fn), "rb") as f:
+                entry = marshal.loads(f.read())
+        except (FileNotFoundError, EOFError, ValueError, TypeError):
+            return None
+        if not isinstance(entry, tuple) or len(entry) != 6 or \
+           entry[0] != CACHE_VERSION:
+            return None
+        return entry
+
+    def _write(self, fn, entry):
+        if self._entries != None:
+            self._entries[fn] = entry
+        self._storage.writeAtomically(self._cachePath(fn),
+                                      marshal.dumps(entry))
+
+    # forget the entry of |fn|, e.g. when it is rewritten: a file rewritten
+    # and appended to within the resolution of mtimes could pass for the
+    # one it replaced.
+    def drop(self, fn):
+        if self._entries != None:
+            self._entries.pop(fn, None)
+        try:
+            os.remove(self._cachePath(fn))
+        except FileNotFoundError:
+            pass
+
+    # Data derived from a whole block, kept in the cache directory under
+    # |name| as long as the block is in |state|, see Storage.blockState().
+    # |build| makes it, as marshal-able data, when it is missing or stale.
+    def derived(self, name, state, build):
+        path = os.path.join(self._dir, name)
+        try:
+            with open(path, "rb") as f:
+                entry = marshal.loads(f.read())
+        except (FileNotFoundError, EOFError, ValueError, TypeError):
+            entry = None
+        if isinstance(entry, tuple) and len(entry) == 3 and \
+           entry[0] == CACHE_VERSION and entry[1] == state:
+            return entry[2]
+        data = build()
+        self.storeDerived(name, state, data)
+        return data
+
+    # keep |data| under |name| for a block in |state|, see derived(), for
+    # data that is kept up to date rather than made again.
+    def storeDerived(self, name, state, data):
+        with instrument.phase("cache.write"):
+            self._storage.writeAtomically(
+                os.path.join(self._dir, name),
+                marshal.dumps((CACHE_VERSION, state, data)))
+
+    # forget the data derived under |name|, see derived().
+    def dropDerived(self, name):
+        try:
+            os.remove(os.path.join(self._dir, name))
+        except FileNotFoundError:
+            pass
+
+    # id -> record tuple for every id in |fn|, None if there's no such file.
+    def load(self, fn):
+        try:
+            st = os.stat(fn)
+        except FileNotFoundError:
+            return None
+        with instrument.phase("cache.read"):
+            entry = self._read(fn)
+        if fn.endswith(".gz"):
+            return self._loadCompressed(fn, st, entry)
+        with instrument.phase("storage.read"), open(fn, "rb") as f:
+            pool = dict()
+            offset = 0
+            tail = b""
+            if entry != None and entry[3] <= st.st_size:
+                f.seek(max(0, entry[3] - TAIL))
+                if f.read(entry[3] - max(0, entry[3] - TAIL)) == entry[4]:
+                    if entry[1] == st.st_size and entry[2] == st.st_mtime_ns:
+                        return entry[5]
+                    pool, offset, tail = entry[5], entry[3], entry[4]
+            f.seek(offset)
+            data = f.read()
+
+        # a line without its newline may still be being written.
+        end = data.rfind(b"\n") + 1
+        with instrument.phase("storage.decode_json"):
+            decoded, bad = decodeLines(data[:end])
+            for at, length, rec in decoded:
+                pool[rec.rId()] = rec.toTuple()
+        if bad > 0:
+            instrument.count("storage.bad_lines", bad)
+            print("warning: skipped {} damaged lines in {}"
+                  .format(bad, fn), file = sys.stderr)
+        offset = offset + end
+        tail = (tail + data[:end])[-TAIL:]
+        with instrument.phase("cache.write"):
+            self._write(fn, (CACHE_VERSION, st.st_size, st.st_mtime_ns,
+                             offset, tail, pool))
+        return pool
+
+    # An archived block, see Storage.archive(), is never appended to: its
+    # entry is used only when the file is the one it was made from.
+    # Otherwise the file is decompressed as a stream and decoded
+    # COMPRESSED_CHUNK bytes at a time.
+    def _loadCompressed(self, fn, st, entry):
+        import gzip
+        if entry != None and entry[1] == st.st_size and \
+           entry[2] == st.st_mtime_ns:
+            return entry[5]
+        pool = dict()
+        bad = 0
+        rest = b""
+        with instrument.phase("storage.decompress"), gzip.open(fn) as f:
+            while True:
+                chunk = f.read(COMPRESSED_CHUNK)
+                data = rest + chunk
+                if chunk == b"" and data.strip() != b"":
+                    # the last line has no newline.
+                    data = data + b"\n"
+                end = data.rfind(b"\n") + 1
+                with instrument.phase("storage.decode_json"):
+                    decoded, n = decodeLines(data[:end])
+                for at, length, rec in decoded:
+                    pool[rec.rId()] = rec.toTuple()
+                bad = bad + n
+                rest = data[end:]
+                if chunk == b"":
+                    break
+        if bad > 0:
+            instrument.count("storage.bad_lines", bad)
+            print("warning: skipped {} damaged lines in {}"
+                  .format(bad, fn), file = sys.stderr)
+        with instrument.phase("cache.write"):
+            self._write(fn, (CACHE_VERSION, st.st_size, st.st_mtime_ns,
+                             st.st_size, b"", pool))
+        return pool
+
+# The records of the lines of |data|, which ends with a newline and starts
+# at byte |base| of its file, as (offset, length, record) in file order,
+# and the number of lines that couldn't be decoded.
+#
+# A line that can't be decoded was cut short by a writer that died. If
+# something was appended after it, on the same line, that part is kept:
+# lines are written by Record.toJson(), which starts with the date.
+def decodeLines(data, base = 0):
+    spans = []
+    lines = []
+    pos = base
+    for raw in data.split(b"\n")[:-1]:
+        line = raw.strip()
+        if line != b"":
+            spans.append((pos + len(raw) - len(raw.lstrip()), len(line)))
+            lines.append(line)
+        pos = pos + len(raw) + 1
+    try:
+        recs = Record.createFromJsonLines([str(l, "utf-8") for l in lines],
+                                          None)
+        return [(o, n, r) for (o, n), r in zip(spans, recs)], 0
+    except (ValueError, KeyError, TypeError, AttributeError):
+        pass
+    out = []
+    bad = 0
+    for (o, n), line in zip(spans, lines):
+        try:
+            out.append((o, n, Record.createFromJson(str(line, "utf-8"),
+                                                    None)))
+            continue
+        except (ValueError, KeyError, TypeError, AttributeError):
+            bad = bad + 1
+        start = line.rfind(b'{"date": ', 1)
+        if start < 0:
+            continue
+        try:
+            out.append((o + start, n - start,
+                        Record.createFromJson(str(line[start:], "utf-8"),
+                                              None)))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            pass
+    return out, bad
@@ -0,0 +1,115 @@
+from record import toMicroseconds
+import marshal, socket, struct, sys
+
+# Client side of 'cs serve', see server.py.
+#
+# Messages are dictionaries, sent as marshal data prefixed by its length:
+# record tuples go over as they are, which is several times cheaper than
+# json, and both ends are the same cs on the same python, which the hello
+# request checks. A request is
+#
+#   {"op": <name>, ...arguments}
+#
+# and is answered by {"result": ...}, or {"error": <message>}. Range
+# requests are answered by a {"records": [...]} message per block, record
+# tuples in date order, followed by {"end": True}. Dates are microseconds
+# since 1970.
+PROTOCOL_VERSION = 2
+FRAME = struct.Struct("<I")
+
+def writeMessage(f, message):
+    data = marshal.dumps(message)
+    f.write(FRAME.pack(len(data)) + data)
+
+# the next message from |f|, None at the end of the stream.
+def readMessage(f):
+    header = f.read(FRAME.size)
+    if len(header) < FRAME.size:
+        return None
+    size, = FRAME.unpack(header)
+    data = f.read(size)
+    if len(data) < size:
+        return None
+    return marshal.loads(data)
+
+class LedgerClient:
+    def __init__(self, sock):
+        self._sock = sock
+        self._file = sock.makefile("rwb")
+
+    # A client of the server listening on |socketPath|, None if there is
+    # no such server or it speaks another version of the protocol.
+    @classmethod
+    def connect(cls, socketPath):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(socketPath)
+            client = cls(sock)
+            hello = client.request({ "op": "hello" })
+        except OSError:
+            sock.close()
+            return None
+        if hello.get("version") != PROTOCOL_VERSION or \
+           hello.get("python") != sys.version:
+            client.close()
+            return None
+        return client
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+    def _send(self, req):
+        writeMessage(self._file, req)
+        self._file.flush()
+
+    def _receive(self):
+        reply = readMessage(self._file)
+        if reply == None:
+            raise ConnectionResetError("cs serve closed the connection")
+        if "error" in reply:
+            raise Exception(reply["error"])
+        return reply
+
+    def request(self, req):
+        self._send(req)
+        return self._receive()["result"]
+
+    # Tuples of the live records of the range in date order, a list per
+    # block. The request is sent right away; the records are read as the
+    # result is iterated, to the end even if the caller stops early.
+    def range(self, start_date, end_date):
+        self._send({ "op": "range", "start": toMicroseconds(start_date),
+                     "end": toMicroseconds(end_date) })
+        def read():
+            done = False
+            try:
+                while True:
+                    reply = self._receive()
+                    if "end" in reply:
+                        done = True
+                        return
+                    yield reply["records"]
+            finally:
+                while not done:
+                    done = "end" in self._receive()
+        return read()
+
+    def summarize(self, start_date, end_date):
+        return self.request({ "op": "summarize",
+                              "start": toMicroseconds(start_date),
+                              "end": toMicroseconds(end_date) })
+
+    # tuple of the record, None if there's no live record with that id.
+    def findById(self, recId):
+        return self.request({ "op": "find", "id": recId })
+
+    # id -> tuple of the live records of |recIds|.
+    def findByIds(self, recIds):
+        return self.request({ "op": "findMany", "ids": list(recIds) })
+
+    def names(self, kind):
+        return self.request({ "op": "names", "kind": kind })
+
+    def usage(self, kind):
+        return self.request({ "op": "usage", "kind": kind })
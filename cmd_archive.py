@@ -0,0 +1,26 @@
+import datetime
+
+# cs archive [--days N]
+#
+# Compact and compress the jsonl blocks whose records are all older than N
+# days, 365 by default; blocks with a binary file are left as they are.
+# Archived blocks are read as before, and stay compressed through cs
+# compact; one that is written to again is made plain jsonl first.
+class ArchiveCommand:
+    def __init__(self, csb):
+        self._csb = csb
+
+    def run(self, argv):
+        days = 365
+        if len(argv) > 0:
+            if len(argv) != 2 or argv[0] != "--days":
+                raise Exception("Usage: cs archive [--days N]")
+            try:
+                days = int(argv[1])
+            except ValueError:
+                raise Exception("bad number of days {}".format(argv[1]))
+        before = datetime.datetime.now(datetime.timezone.utc) - \
+            datetime.timedelta(days = days)
+        n, size, compressed = self._csb.archive(before)
+        print("Archived {} blocks, {} bytes to {}"
+              .format(n, size, compressed))
@@ -0,0 +1,7 @@
+class CompactCommand:
+    def __init__(self, csb):
+        self._csb = csb
+
+    def run(self, argv):
+        blocks, lines = self._csb.compact()
+        print("Compacted {} blocks, {} lines removed".format(blocks, lines))
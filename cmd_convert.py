@@ -0,0 +1,12 @@
+class ConvertCommand:
+    formats = { "bin": True, "jsonl": False }
+
+    def __init__(self, csb):
+        self._csb = csb
+
+    def run(self, argv):
+        if len(argv) < 1 or not argv[0] in self.formats:
+            raise Exception("Format must be one of: {}"
+                            .format(", ".join(self.formats)))
+        n = self._csb.convert(self.formats[argv[0]])
+        print("Converted {} blocks to {}".format(n, argv[0]))
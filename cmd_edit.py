@@ -1,13 +1,76 @@
-from user_input import getUserInput
+from idargs import readIds
+import math
+
+# cs edit <id>
+# cs edit <id>... --set field=value [--set field=value]...
+#
+# With one id and no --set, the record is edited interactively. --set
+# changes the field of every given record instead, without asking; the
+# fields are summary, type, tags, amount and payment, and tags are
+# separated by ';'. '-' reads ids from stdin, see idargs.readIds().
+
+# field -> (setter name, parse function)
+FIELDS = {
+    "summary": ("summary", str),
+    "type":    ("typ", str),
+    "tags":    ("tags", lambda v: [t.strip() for t in v.split(";")
+                                   if t.strip() != ""]),
+    "amount":  ("amount", lambda v: float(v.replace(",", ""))),
+    "payment": ("paymentMethod", str)
+}
 
 class EditCommand:
     def __init__(self, csb):
         self._csb = csb
+
+    # (setter name, value) of each --set of |argv|, and the rest of it.
+    def parseSets(self, argv):
+        sets = []
+        rest = []
+        i = 0
+        while i < len(argv):
+            if argv[i] != "--set":
+                rest.append(argv[i])
+                i = i + 1
+                continue
+            if i + 1 >= len(argv) or not "=" in argv[i + 1]:
+                raise Exception("--set needs field=value")
+            field, value = argv[i + 1].split("=", 1)
+            if not field in FIELDS:
+                raise Exception("Fields are: {}"
+                                .format(", ".join(FIELDS)))
+            setter, parse = FIELDS[field]
+            try:
+                value = parse(value)
+            except ValueError:
+                raise Exception("bad {} {}".format(field, value))
+            if field == "amount" and not math.isfinite(value):
+                raise Exception("bad amount {}".format(value))
+            sets.append((setter, value))
+            i = i + 2
+        return sets, rest
+
     def run(self, argv):
-        if len(argv) < 1:
-            raise Exception("ID isn't specified")
+        sets, argv = self.parseSets(argv)
+        recIds = readIds(argv)
+        if len(sets) == 0:
+            if len(recIds) > 1:
+                raise Exception("Give --set to edit several records")
+            self.edit(recIds[0])
+            return
+        found = self._csb.findAllByIds(recIds)
+        # the new versions go out with one append per block.
+        with self._csb.groupCommit():
+            for recId in recIds:
+                rec = found[recId]
+                for setter, value in sets:
+                    getattr(rec, setter)(value)
+                rec.store()
+        for recId in recIds:
+            print("Record {} updated".format(recId))
 
-        recId = argv[0]
+    def edit(self, recId):
+        from user_input import getUserInput
         rec = self._csb.findById(recId)
         if rec == None:
             raise Exception("ID {} is not found.".format(recId))
@@ -0,0 +1,156 @@
+from record import Record
+from storage import blockNumber
+import csv, json, math, sys
+
+# cs import <file> [--format csv|jsonl] [--dry-run]
+#
+# Import records from a csv file with a header row, or from json lines.
+# The fields are date, summary, type, tags, amount, currency and payment;
+# summary and tags may be left out, currency defaults to NTD. In csv,
+# tags are separated by ';'. Dates without a timezone are local time.
+#
+# A row may carry the id of a record, e.g. lines copied from another
+# ledger: then later rows with the same id replace earlier ones and rows
+# marked deleted drop it, like in a block file. Other rows get new ids.
+#
+# Every row is checked before anything is written; if any row is bad,
+# nothing is imported.
+MAX_ERRORS = 10
+
+class ImportCommand:
+    formats = [ "csv", "jsonl" ]
+    required = [ "date", "type", "amount", "payment" ]
+
+    def __init__(self, csb):
+        self._csb = csb
+
+    def parseArgs(self, argv):
+        path = None
+        fmt = None
+        dryRun = False
+        i = 0
+        while i < len(argv):
+            if argv[i] == "--format" and i + 1 < len(argv):
+                fmt = argv[i + 1]
+                i = i + 1
+            elif argv[i] == "--dry-run":
+                dryRun = True
+            elif path == None:
+                path = argv[i]
+            else:
+                raise Exception("Unexpected argument {}".format(argv[i]))
+            i = i + 1
+        if path == None:
+            raise Exception("File isn't specified")
+        if fmt == None:
+            fmt = path.rsplit(".", 1)[-1].lower()
+            fmt = "jsonl" if fmt == "json" else fmt
+        if not fmt in self.formats:
+            raise Exception("Format must be one of: {}"
+                            .format(", ".join(self.formats)))
+        return path, fmt, dryRun
+
+    # (line number, row) of each row of |f|.
+    def readCsv(self, f):
+        reader = csv.DictReader(f)
+        missing = [k for k in self.required
+                   if not k in (reader.fieldnames or [])]
+        if len(missing) > 0:
+            raise Exception("Columns missing: {}".format(", ".join(missing)))
+        for row in reader:
+            tags = row.get("tags") or ""
+            row["tags"] = tags.split(";")
+            amount = row.get("amount")
+            if amount != None:
+                row["amount"] = amount.replace(",", "")
+            yield reader.line_num, row
+
+    def readJsonl(self, f):
+        for n, line in enumerate(f, 1):
+            if line.strip() == "":
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                row = e
+            yield n, row
+
+    # the record dictionary of |row|, see Record.createFromDictionary().
+    def validate(self, row):
+        if isinstance(row, ValueError):
+            raise Exception("bad json: {}".format(row))
+        if not isinstance(row, dict):
+            raise Exception("not a record: {}".format(row))
+        for k in self.required:
+            if row.get(k) in (None, ""):
+                raise Exception("{} is missing".format(k))
+        out = dict()
+        try:
+            out["date"] = Record.parseDate(str(row["date"]).strip())
+        except (ValueError, OverflowError):
+            raise Exception("bad date {}".format(row["date"]))
+        try:
+            out["amount"] = float(row["amount"])
+        except (ValueError, TypeError):
+            raise Exception("bad amount {}".format(row["amount"]))
+        if not math.isfinite(out["amount"]):
+            raise Exception("bad amount {}".format(row["amount"]))
+        tags = row.get("tags") or []
+        if not isinstance(tags, list):
+            raise Exception("bad tags {}".format(tags))
+        out["tags"] = [t.strip() for t in map(str, tags) if t.strip() != ""]
+        out["summary"] = str(row.get("summary") or "").strip()
+        out["type"] = str(row["type"]).strip()
+        out["payment"] = str(row["payment"]).strip()
+        out["currency"] = str(row.get("currency") or "NTD").strip()
+        if row.get("id") not in (None, ""):
+            out["id"] = str(row["id"]).strip()
+            if Record.dateOfId(out["id"]) == None:
+                raise Exception("bad id {}".format(out["id"]))
+        deleted = row.get("deleted", False)
+        out["deleted"] = deleted == True or \
+            str(deleted).strip().lower() == "true"
+        return out
+
+    def run(self, argv):
+        path, fmt, dryRun = self.parseArgs(argv)
+        reader = self.readCsv if fmt == "csv" else self.readJsonl
+        errors = []
+        withId = dict() # id -> record dictionary, latest row wins
+        withoutId = []
+        f = sys.stdin if path == "-" else \
+            open(path, "r", encoding = "utf-8-sig", newline = "")
+        with f:
+            for n, row in reader(f):
+                try:
+                    dic = self.validate(row)
+                except Exception as e:
+                    errors.append("line {}: {}".format(n, e))
+                    continue
+                if "id" in dic:
+                    withId[dic["id"]] = dic
+                elif not dic["deleted"]:
+                    withoutId.append(dic)
+
+        dicts = [d for d in withId.values() if not d["deleted"]]
+        allocator = self._csb.idAllocator()
+        for dic in dicts:
+            if allocator.taken(dic["id"]):
+                errors.append("id {} is in the ledger already"
+                              .format(dic["id"]))
+            allocator.reserve(dic["id"])
+        if len(errors) > 0:
+            raise Exception("{} bad rows, nothing imported:\n{}".format(
+                len(errors), "\n".join(errors[:MAX_ERRORS])))
+        for dic in withoutId:
+            dic["id"] = allocator.allocate(dic["date"])
+        dicts.extend(withoutId)
+
+        recs = [self._csb.makeRecord(d) for d in dicts]
+        if dryRun:
+            blocks = len(set(blockNumber(r.date()) for r in recs))
+            print("Would import {} records into {} blocks"
+                  .format(len(recs), blocks))
+            return
+        blocks = self._csb.storeMany(recs) if len(recs) > 0 else 0
+        print("Imported {} records into {} blocks".format(len(recs), blocks))
@@ -0,0 +1,94 @@
+from cmd_view import RangeParser, ViewCommand
+from columns import PERIODS, runningTotals, topN
+import datetime
+import dateutil.tz
+import instrument
+
+# cs report [range | --from date --to date] [--by dim[,dim...]] [--top N]
+#           [--running]
+#
+# Totals of the records in the range, grouped by one or more of year,
+# month, week, day, type, tag, payment and currency (month by default).
+# --top keeps the N largest groups of the last dimension within the groups
+# before it and adds up the others; --running adds running totals.
+class ReportCommand:
+    dimensions = PERIODS + [ "type", "tag", "payment", "currency" ]
+
+    def __init__(self, csb):
+        self._csb = csb
+
+    def parseArgs(self, argv):
+        rangeArg = ""
+        bounds = dict()
+        dims = [ "month" ]
+        top = None
+        running = False
+        i = 0
+        while i < len(argv):
+            if argv[i] == "--by" and i + 1 < len(argv):
+                dims = [d.strip() for d in argv[i + 1].split(",")]
+                i = i + 1
+            elif argv[i] == "--top" and i + 1 < len(argv):
+                top = int(argv[i + 1])
+                i = i + 1
+            elif argv[i] == "--running":
+                running = True
+            elif argv[i] in ["--from", "--to"] and i + 1 < len(argv):
+                bounds[argv[i]] = argv[i + 1]
+                i = i + 1
+            else:
+                rangeArg = argv[i]
+            i = i + 1
+        for d in dims:
+            if not d in self.dimensions:
+                raise Exception("Can't group by {}, use one of: {}"
+                                .format(d, ", ".join(self.dimensions)))
+        if top != None and dims[-1] in PERIODS:
+            raise Exception("--top needs a type, tag, payment or currency "
+                            "grouping last")
+        if len(bounds) > 0 and rangeArg != "":
+            raise Exception("Give either a range or --from and --to")
+        return rangeArg, bounds, dims, top, running
+
+    def showGroups(self, dims, groups, totals, running):
+        widths = [max([len(d)] + [len(g[0][i]) for g in groups]) + 2
+                  for i, d in enumerate(dims)]
+        print("".join("{:{}}".format(d, w) for d, w in zip(dims, widths)) +
+              "{:>7} {:>16}".format("count", "amount") +
+              ("{:>21}".format("running") if running else ""))
+        print("-"*80)
+        runs = runningTotals(groups) if running else [None] * len(groups)
+        for (labels, currency, amount, count), run in zip(groups, runs):
+            line = "".join(ViewCommand.formatWithCJKChar(l, w)
+                           for l, w in zip(labels, widths))
+            line = line + "{:7} {:16,.2f} {:3}".format(count, amount, currency)
+            if run != None:
+                line = line + " {:16,.2f}".format(run)
+            print(line)
+        print("-"*80)
+        for labels, currency, amount, count in totals:
+            print("{:{}}{:7} {:16,.2f} {:3}".format("Total", sum(widths),
+                                                   count, amount, currency))
+
+    def run(self, argv):
+        rangeArg, bounds, dims, top, running = self.parseArgs(argv)
+        tz = dateutil.tz.tzlocal()
+        now = datetime.datetime.now(tz)
+        if len(bounds) > 0:
+            rangeParser = RangeParser(bounds.get("--from", ""), now,
+                                      bounds.get("--to", ""))
+        else:
+            rangeParser = RangeParser(rangeArg, now = now)
+        with instrument.phase("report.load"):
+            cols = self._csb.columns(rangeParser.start(), rangeParser.end())
+        with instrument.phase("report.group"):
+            groups = cols.groupBy(dims, tz)
+            if top != None:
+                groups = topN(groups, top)
+            totals = cols.groupBy([], tz)
+
+        print("="*80)
+        print("Report by {}".format(", ".join(dims)))
+        print("-"*80)
+        with instrument.phase("report.print"):
+            self.showGroups(dims, groups, totals, running)
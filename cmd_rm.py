@@ -1,14 +1,20 @@
+from idargs import readIds
+
+# cs rm <id>... | cs rm -
+#
+# Delete the records with the given ids; '-' reads the ids from stdin,
+# separated by whitespace. Every id is looked up before anything is
+# written, and if one isn't found nothing is deleted.
 class RemoveCommand:
     def __init__(self, csb):
         self._csb = csb
 
     def run(self, argv):
-        if len(argv) < 1:
-            raise Exception("ID isn't specified")
-
-        recId = argv[0]
-        rec = self._csb.findById(recId)
-        if rec == None:
-            raise Exception("ID {} is not found.".format(recId))
-        rec.delete()
-        print("Record {} deleted".format(recId))
+        recIds = readIds(argv)
+        found = self._csb.findAllByIds(recIds)
+        # the tombstones go out with one append per block.
+        with self._csb.groupCommit():
+            for recId in recIds:
+                found[recId].delete()
+        for recId in recIds:
+            print("Record {} deleted".format(recId))
@@ -0,0 +1,38 @@
+from index import emptyRollup, addToRollup
+from render import makeRenderer
+import instrument
+
+# cs search <word>... [--format text|json|csv|tsv]
+#
+# Records whose summary has every one of the words, oldest first, and
+# their totals. Case and full or half width forms don't matter. Words
+# match whole words of a summary, while Chinese, Japanese and Korean text
+# matches anywhere in it. The index is kept per block and isn't updated
+# by writes: a block that changed since the last search is read and
+# indexed again in full.
+class SearchCommand:
+    def __init__(self, csb, out = None):
+        self._csb = csb
+        self._out = out
+
+    def run(self, argv):
+        fmt = "text"
+        if "--format" in argv:
+            i = argv.index("--format")
+            if i + 1 >= len(argv):
+                raise Exception("Format isn't specified")
+            fmt = argv[i + 1]
+            argv = argv[:i] + argv[i + 2:]
+        if len(argv) == 0:
+            raise Exception("Nothing to search for")
+        renderer = makeRenderer(fmt, self._out)
+        with instrument.phase("search"):
+            recs = self._csb.search(" ".join(argv))
+        with instrument.phase("view.list"):
+            renderer.itemList(recs)
+        if renderer.withSummary:
+            rollup = emptyRollup()
+            for rec in recs:
+                addToRollup(rollup, rec)
+            renderer.summary(rollup)
+        renderer.close()
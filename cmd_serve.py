@@ -0,0 +1,6 @@
+class ServeCommand:
+    def __init__(self, csb):
+        self._csb = csb
+
+    def run(self, argv):
+        self._csb.serve()
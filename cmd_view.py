@@ -1,6 +1,9 @@
 
-import re, datetime, calendar, unicodedata
+import re, datetime, calendar
 import dateutil.tz
+from render import LocalTime, makeRenderer, padToWidth
+from index import emptyRollup, addToRollup
+import instrument
 
 # get a new date object that is obtained by month + diff.
 # this covers minus month and that case that the target month
@@ -24,11 +27,53 @@ class RangeParser:
     dayMatcher       = re.compile(r"(\d*)d{0,1}$")
     thisYearMatcher  = re.compile(r"y$")
     thisMonthMatcher = re.compile(r"m$")
+    hourMatcher      = re.compile(r"(\d+)h$")
+    dateMatcher      = re.compile(
+        r"(\d{4})-(\d{1,2})(?:-(\d{1,2})(?:[T ](\d{1,2})(?::(\d{2}))?)?)?$")
+
+    # A range is a single argument, see parseSingle(), or two, given as
+    # |arg| and |arg2| or as "arg..arg2": from the start of the first to
+    # the end of the second. A side left empty is open, from 1970 or until
+    # now. A relative argument ends where it starts, so 30d..7d is from 30
+    # days ago until 7 days ago.
     def __init__(self, arg, now, arg2 = None):
         self._now = now
         self._start = None
         self._end = now
-        self.parseSingle(arg)
+        self._absolute = False
+        if arg2 == None and ".." in arg:
+            arg, arg2 = arg.split("..", 1)
+        if arg2 == None:
+            self.parseSingle(arg)
+            return
+        self._start = RangeParser(arg, now).start() if arg != "" else \
+            datetime.datetime(1970, 1, 1, tzinfo = now.tzinfo)
+        if arg2 != "":
+            last = RangeParser(arg2, now)
+            self._end = last.end() if last.absolute() else \
+                last.start() - datetime.timedelta(microseconds = 1)
+        if self._end < self._start:
+            raise Exception("The range ends before it starts")
+
+    # An absolute date, 2024-01, 2024-01-05, 2024-01-05T08 or
+    # 2024-01-05T08:30, stands for the month, day, hour or minute it names,
+    # in the timezone of now.
+    def parseDate(self, m):
+        year, month, day, hour, minute = \
+            [None if g == None else int(g) for g in m.groups()]
+        start = datetime.datetime(year, month, day or 1, hour or 0,
+                                  minute or 0, tzinfo = self._now.tzinfo)
+        if day == None:
+            end = monthDiff(start, 1)
+        elif hour == None:
+            end = start + datetime.timedelta(days = 1)
+        elif minute == None:
+            end = start + datetime.timedelta(hours = 1)
+        else:
+            end = start + datetime.timedelta(minutes = 1)
+        self._start = start
+        self._end = end - datetime.timedelta(microseconds = 1)
+        self._absolute = True
 
     def parseSingle(self, arg):
         """Handle a single param to stand for a range"""
@@ -36,6 +81,18 @@ class RangeParser:
         d1 = None
         matched = False
 
+        m = self.dateMatcher.match(arg)
+        if m != None:
+            self.parseDate(m)
+            return
+
+        # the last hours, which don't start at midnight.
+        m = self.hourMatcher.match(arg)
+        if m != None:
+            self._start = self._now - \
+                datetime.timedelta(hours = int(m.group(1)))
+            return
+
         m = self.dayMatcher.match(arg)
         if m != None:
             d1 = dayDiff(self._now, -number_filter(m.group(1)))
@@ -73,26 +130,9 @@ class RangeParser:
     def end(self):
         return self._end
 
-class PerCurrencyCollector:
-    def __init__(self):
-        self._sum = dict()
-
-    def put(self, rec):
-        crcy = rec.currency()
-        if crcy in self._sum:
-            self._sum[crcy] = self._sum[crcy] + rec.amount()
-        else:
-            self._sum[crcy] = rec.amount()
-
-    def items(self):
-        return self._sum.items()
+    def absolute(self):
+        return self._absolute
 
-    def summarize(self, indent=2):
-        out = ""
-        for cur, amt in self.items():
-            out = out + "{}{:10,.2f} {}\n".format(" "*indent, amt, cur)
-        return out
-    
 class ViewCommand:
     @classmethod
     def dateFormatter(cls, date):
@@ -100,71 +140,108 @@ class ViewCommand:
 
     @classmethod
     def formatWithCJKChar(cls, text, width):
-        num_cjk = 0
-        for c in text:
-            num_cjk = num_cjk + 1 if unicodedata.east_asian_width(c) == 'W' else 0
-        width = width - num_cjk
-        return "{0:{1}}".format(text, width)
-    
-    def __init__(self, csb):
-        self._csb = csb
+        return padToWidth(text, width)
 
-    def listAll(self, recs):
-        cur_date = None
-        for rec in recs.dateSorted():
-            localtime = rec.date().astimezone(dateutil.tz.tzlocal())
-            if cur_date != localtime.date():
-                cur_date = localtime.date()
-                print(cur_date.strftime("%a %b %d, %Y"))
-            print(
-""" * {:<6}{}
-   Summary:  {}
-   Tag:      {}
-   Pay with: {}
-   ID:       {}
-   {:73,.2f} {:3}
-""".format(localtime.strftime("%H:%M"), "." * 71,
-           rec.summary(),
-           ## new line
-           self.formatWithCJKChar(", ".join(rec.tags()), 53),
-           rec.paymentMethod(),
-           rec.rId(),
-           ## new line
-           rec.amount(), rec.currency()))
-
-    def showSummary(self, recs):
-        total = PerCurrencyCollector()
-        payment = dict()
-        for rec in recs.unsorted():
-            total.put(rec)
-            if not rec.paymentMethod() in payment:
-                payment[rec.paymentMethod()] = PerCurrencyCollector()
-            payment[rec.paymentMethod()].put(rec)
-        print("Payment method summary:")
-        for p, t in payment.items():
-            print("  {}:".format(p))
-            print(t.summarize(4))
-        print('-'*80)
-        print("Total:")
-        print(total.summarize())
+    def __init__(self, csb, out = None):
+        self._csb = csb
+        self._out = out
+
+    # print |recs|, which are in date order, as they come.
+    def listAll(self, recs, renderer):
+        with instrument.phase("view.list"):
+            renderer.itemList(recs)
+
+    def showRollup(self, rollup, renderer, detail = False):
+        with instrument.phase("view.summary"):
+            renderer.summary(rollup, detail)
+
+    # the records of the range that match |filters|. The stored rollups
+    # have the totals of every record, so those of the matching ones are
+    # added up as they are listed.
+    def showFiltered(self, range_parser, filters, summary_only, renderer):
+        rollup = emptyRollup()
+        def counted(recs):
+            for rec in recs:
+                addToRollup(rollup, rec)
+                yield rec
+        recs = counted(self._csb.iterFiltered(range_parser.start(),
+                                              range_parser.end(), filters))
+        if summary_only:
+            with instrument.phase("storage.summarize"):
+                for rec in recs:
+                    pass
+            self.showRollup(rollup, renderer, detail = True)
+            return
+        self.listAll(recs, renderer)
+        if renderer.withSummary:
+            self.showRollup(rollup, renderer)
 
     def run(self, argv):
         range_parser = None
-        now = datetime.datetime.now(dateutil.tz.tzlocal())
+        localTime = LocalTime()
+        now = datetime.datetime.now(localTime.tz())
+        # --summary (-s) only prints totals, which don't need the records.
+        summary_only = "--summary" in argv or "-s" in argv
+        argv = [a for a in argv if not a in ["--summary", "-s"]]
+        # --format json|csv|tsv prints records or totals without the
+        # layout, for other programs.
+        fmt = "text"
+        if "--format" in argv:
+            i = argv.index("--format")
+            if i + 1 >= len(argv):
+                raise Exception("Format isn't specified")
+            fmt = argv[i + 1]
+            argv = argv[:i] + argv[i + 2:]
+        # --from and --to give the ends of the range, see RangeParser.
+        bounds = dict()
+        for opt in ["--from", "--to"]:
+            if opt in argv:
+                i = argv.index(opt)
+                if i + 1 >= len(argv):
+                    raise Exception("{} needs a date".format(opt))
+                bounds[opt] = argv[i + 1]
+                argv = argv[:i] + argv[i + 2:]
+        if len(bounds) > 0 and len(argv) > 0:
+            raise Exception("Give either a range or --from and --to")
+        # --tag, --type and --payment only show the records that have the
+        # value; an option given several times matches any of its values.
+        filters = dict()
+        for opt in ["--tag", "--type", "--payment"]:
+            while opt in argv:
+                i = argv.index(opt)
+                if i + 1 >= len(argv):
+                    raise Exception("{} needs a value".format(opt))
+                filters.setdefault(opt[2:], []).append(argv[i + 1])
+                argv = argv[:i] + argv[i + 2:]
+        renderer = makeRenderer(fmt, self._out, localTime)
         try:
-            range_parser = RangeParser(argv[0] if len(argv) > 0 else "",
-                                       now = now)
+            if len(bounds) > 0:
+                range_parser = RangeParser(bounds.get("--from", ""), now,
+                                           bounds.get("--to", ""))
+            else:
+                range_parser = RangeParser(argv[0] if len(argv) > 0 else "",
+                                           now = now)
         except:
             print("Fail to parse argument")
             raise
-        recs = self._csb.queryRange(range_parser.start(),
-                                    range_parser.end())
-        print("="*80)
-        print("Item list")
-        print("-"*80)
-        self.listAll(recs)
-
-        print("="*80)
-        print("Summary")
-        print("-"*80)
-        self.showSummary(recs)
+        if len(filters) > 0:
+            self.showFiltered(range_parser, filters, summary_only, renderer)
+            renderer.close()
+            return
+        if summary_only:
+            with instrument.phase("storage.summarize"):
+                rollup = self._csb.summarize(range_parser.start(),
+                                             range_parser.end())
+            self.showRollup(rollup, renderer, detail = True)
+            renderer.close()
+            return
+        self.listAll(self._csb.iterRange(range_parser.start(),
+                                         range_parser.end()), renderer)
+        # the totals come from the rollups rather than from summing up the
+        # records on the way.
+        if renderer.withSummary:
+            with instrument.phase("storage.summarize"):
+                rollup = self._csb.summarize(range_parser.start(),
+                                             range_parser.end())
+            self.showRollup(rollup, renderer)
+        renderer.close()
@@ -0,0 +1,287 @@
+from record import toMicroseconds
+from array import array
+import bisect, datetime, itertools
+
+# numpy is optional: with it the passes over the rows are vectorized,
+# without it the same passes run in plain python.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+PERIODS = [ "year", "month", "week", "day" ]
+
+# start of the |kind| period that |date| is in, in the timezone of |date|.
+def periodStart(kind, date):
+    day = date.date()
+    if kind == "year":
+        day = day.replace(month = 1, day = 1)
+    elif kind == "month":
+        day = day.replace(day = 1)
+    elif kind == "week":
+        day = day - datetime.timedelta(days = day.weekday())
+    return datetime.datetime(day.year, day.month, day.day,
+                             tzinfo = date.tzinfo)
+
+def nextPeriodStart(kind, start):
+    if kind == "year":
+        return start.replace(year = start.year + 1)
+    if kind == "month":
+        if start.month == 12:
+            return start.replace(year = start.year + 1, month = 1)
+        return start.replace(month = start.month + 1)
+    days = 7 if kind == "week" else 1
+    day = start.date() + datetime.timedelta(days = days)
+    return datetime.datetime(day.year, day.month, day.day,
+                             tzinfo = start.tzinfo)
+
+def periodLabel(kind, start):
+    if kind == "year":
+        return start.strftime("%Y")
+    if kind == "month":
+        return start.strftime("%Y-%m")
+    if kind == "week":
+        year, week, weekday = start.isocalendar()
+        return "{}-W{:02}".format(year, week)
+    return start.strftime("%Y-%m-%d")
+
+# The records of a range column by column, for reports. Type, payment
+# method, currency and tags are kept as codes into a dictionary that the
+# columns share, and the tags of a row are a range in a column of tag
+# codes. Rows are in date order, so the rows of a period are a slice that
+# is found by binary search.
+#
+# Group-bys make a key column per dimension, combine them into one key
+# per row and sum the amounts by key in a single pass; only the groups,
+# not the rows, are handled one by one afterwards.
+class ColumnSet:
+    categorical = {
+        "type":     3,  # index in record tuples
+        "currency": 6,
+        "payment":  7
+    }
+
+    def __init__(self, useNumpy = None):
+        self._numpy = numpy != None if useNumpy == None else useNumpy
+        if self._numpy and numpy == None:
+            raise Exception("numpy isn't installed")
+        self._epoch = array("q")
+        self._amount = array("d")
+        self._codes = { k: array("I") for k in self.categorical }
+        self._tagStart = array("I", [0])
+        self._tagCode = array("I")
+        self._names = [] # code -> string
+        self._dictionary = dict() # string -> code
+
+    def __len__(self):
+        return len(self._epoch)
+
+    def _code(self, s):
+        c = self._dictionary.get(s)
+        if c == None:
+            c = self._dictionary[s] = len(self._names)
+            self._names.append(s)
+        return c
+
+    # append record tuples that come after the rows already in the set,
+    # e.g. a block of Storage.iterRangeTuples().
+    def extend(self, tuples):
+        code = self._code
+        self._epoch.extend(t[1] for t in tuples)
+        self._amount.extend(t[5] for t in tuples)
+        for k, i in self.categorical.items():
+            self._codes[k].extend(code(t[i]) for t in tuples)
+        self._tagCode.extend(code(v) for t in tuples for v in t[4])
+        self._tagStart.extend(itertools.islice(
+            itertools.accumulate((len(t[4]) for t in tuples),
+                                 initial = self._tagStart[-1]), 1, None))
+
+    # append the rows of |other|, which come after the rows in the set.
+    def append(self, other):
+        remap = [self._code(s) for s in other._names]
+        identity = remap == list(range(len(remap)))
+        def codes(col):
+            return col if identity else array("I", map(remap.__getitem__, col))
+        self._epoch.extend(other._epoch)
+        self._amount.extend(other._amount)
+        for k in self.categorical:
+            self._codes[k].extend(codes(other._codes[k]))
+        self._tagCode.extend(codes(other._tagCode))
+        base = self._tagStart[-1]
+        self._tagStart.extend(array("I", (s + base for s in
+                                          itertools.islice(other._tagStart,
+                                                           1, None))))
+
+    # the content as plain data, e.g. for marshal, and back.
+    def dump(self):
+        return (self._names, self._epoch.tobytes(), self._amount.tobytes(),
+                [self._codes[k].tobytes() for k in self.categorical],
+                self._tagStart.tobytes(), self._tagCode.tobytes())
+
+    @classmethod
+    def load(cls, data, useNumpy = None):
+        out = cls(useNumpy)
+        names, epoch, amount, codes, tagStart, tagCode = data
+        out._names = list(names)
+        out._dictionary = { s: c for c, s in enumerate(out._names) }
+        out._epoch = array("q", epoch)
+        out._amount = array("d", amount)
+        for k, col in zip(out.categorical, codes):
+            out._codes[k] = array("I", col)
+        out._tagStart = array("I", tagStart)
+        out._tagCode = array("I", tagCode)
+        return out
+
+    # column |col| as a numpy array, or as it is.
+    def _vector(self, col):
+        if not self._numpy:
+            return col
+        dtype = { "q": numpy.int64, "d": numpy.float64,
+                  "I": numpy.uint32 }[col.typecode]
+        return numpy.frombuffer(col, dtype = dtype) if len(col) > 0 \
+            else numpy.zeros(0, dtype = dtype)
+
+    # row index of each item of a column of |lengths|-long runs.
+    def _repeat(self, lengths):
+        if self._numpy:
+            return numpy.repeat(numpy.arange(len(lengths)), lengths)
+        return array("I", itertools.chain.from_iterable(
+            itertools.repeat(i, n) for i, n in enumerate(lengths)))
+
+    def _gather(self, col, rows):
+        if rows is None:
+            return col
+        if self._numpy:
+            return col[rows]
+        return [col[i] for i in rows]
+
+    # period index of every row and the start of every period.
+    def _periods(self, kind, tz):
+        if len(self) == 0:
+            return self._repeat([]), []
+        last = datetime.datetime.fromtimestamp(self._epoch[-1] / 1000000, tz)
+        starts = [periodStart(kind, datetime.datetime.fromtimestamp(
+            self._epoch[0] / 1000000, tz))]
+        while starts[-1] <= last:
+            starts.append(nextPeriodStart(kind, starts[-1]))
+        offsets = [bisect.bisect_left(self._epoch, toMicroseconds(s))
+                   for s in starts]
+        lengths = [hi - lo for lo, hi in zip(offsets, offsets[1:])]
+        return self._repeat(lengths), starts[:-1]
+
+    # Totals of the rows grouped by |dims|, a list of names of categorical
+    # columns, "tag" or periods (see PERIODS) in the timezone |tz|. Amounts
+    # in different currencies are never added up, so currency is always
+    # part of the key. Returns (labels, currency, amount, count) tuples,
+    # labels having a value per dimension, with periods in date order and
+    # other values by decreasing amount within the groups before them. A
+    # row with several tags counts for each of them; rows without tags
+    # don't show when grouping by tag.
+    def groupBy(self, dims, tz = datetime.timezone.utc):
+        rows = None
+        if "tag" in dims:
+            tagStart = self._vector(self._tagStart)
+            rows = self._repeat(tagStart[1:] - tagStart[:-1]) \
+                if self._numpy else \
+                self._repeat([b - a for a, b in zip(self._tagStart,
+                                                    self._tagStart[1:])])
+        keys = []
+        labels = []
+        for d in dims + [ "currency" ]:
+            if d in PERIODS:
+                col, starts = self._periods(d, tz)
+                keys.append((self._gather(col, rows), len(starts)))
+                labels.append([periodLabel(d, s) for s in starts])
+            elif d == "tag":
+                keys.append((self._vector(self._tagCode), len(self._names)))
+                labels.append(self._names)
+            elif d in self.categorical:
+                keys.append((self._gather(self._vector(self._codes[d]), rows),
+                             len(self._names)))
+                labels.append(self._names)
+            else:
+                raise Exception("Can't group by {}".format(d))
+        amounts = self._gather(self._vector(self._amount), rows)
+
+        # one key per row: the codes of the dimensions as digits of a
+        # number.
+        if self._numpy:
+            key = numpy.zeros(len(amounts), dtype = numpy.int64)
+            for col, n in keys:
+                key = key * n + col
+            unique, inverse = numpy.unique(key, return_inverse = True)
+            sums = numpy.bincount(inverse, weights = amounts,
+                                  minlength = len(unique)).tolist()
+            counts = numpy.bincount(inverse,
+                                    minlength = len(unique)).tolist()
+            totals = zip(unique.tolist(), sums, counts)
+        else:
+            key = [0] * len(amounts)
+            for col, n in keys:
+                key = [k * n + c for k, c in zip(key, col)]
+            sums = dict()
+            counts = dict()
+            for k, a in zip(key, amounts):
+                sums[k] = sums.get(k, 0.0) + a
+                counts[k] = counts.get(k, 0) + 1
+            totals = ((k, sums[k], counts[k]) for k in sorted(sums))
+
+        groups = []
+        for k, amount, count in totals:
+            codes = []
+            for col, n in reversed(keys):
+                k, c = divmod(k, n)
+                codes.append(c)
+            codes.reverse()
+            groups.append((codes, amount, count))
+        return self._order(dims, groups, labels)
+
+    def _order(self, dims, groups, labels):
+        prefixTotals = dict()
+        for codes, amount, count in groups:
+            for i in range(1, len(dims) + 1):
+                prefix = tuple(codes[:i])
+                prefixTotals[prefix] = prefixTotals.get(prefix, 0.0) + amount
+        def order(group):
+            codes = group[0]
+            return tuple(codes[i] if dims[i] in PERIODS else
+                         -prefixTotals[tuple(codes[:i + 1])]
+                         for i in range(len(dims))) + tuple(codes)
+        out = []
+        for codes, amount, count in sorted(groups, key = order):
+            out.append((tuple(labels[i][c] for i, c in
+                              enumerate(codes[:-1])),
+                        labels[-1][codes[-1]], amount, count))
+        return out
+
+# Running totals of |groups| from ColumnSet.groupBy(): the sum of the
+# amounts so far of every group with the same labels, except the first,
+# and currency. With a period first, that is the total up to each period.
+def runningTotals(groups):
+    sums = dict()
+    out = []
+    for labels, currency, amount, count in groups:
+        k = (labels[1:], currency)
+        sums[k] = sums.get(k, 0.0) + amount
+        out.append(sums[k])
+    return out
+
+# Keep the |n| largest groups among those with the same labels, except the
+# last, and currency; the others are added up into a group labelled
+# |others|. |groups| is ordered as ColumnSet.groupBy() returns them.
+def topN(groups, n, others = "(others)"):
+    out = []
+    kept = dict()
+    rest = dict() # prefix -> index of its others group in out
+    for labels, currency, amount, count in groups:
+        k = (labels[:-1], currency)
+        kept[k] = kept.get(k, 0) + 1
+        if kept[k] <= n:
+            out.append((labels, currency, amount, count))
+        elif not k in rest:
+            rest[k] = len(out)
+            out.append((labels[:-1] + (others,), currency, amount, count))
+        else:
+            l, c, a, m = out[rest[k]]
+            out[rest[k]] = (l, c, a + amount, m + count)
+    return out
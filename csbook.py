@@ -1,19 +1,72 @@
-from record import Record
+from record import Record, RecordSet
 from storage import Storage
+import os
 
 class CSBook:
-    def __init__(self, storage):
+    def __init__(self, storage, socketPath = None):
         self._storage = storage
+        self._socketPath = socketPath
 
     def makeRecord(self, dic):
         return Record.createFromDictionary(dic, self._storage)
 
+    # store |recs| with a write per block, see Storage.insertMany().
+    def storeMany(self, recs):
+        return Record.storeMany(recs, self._storage)
+
+    # records stored within are written together, see
+    # Storage.groupCommit().
+    def groupCommit(self):
+        return self._storage.groupCommit()
+
+    def idAllocator(self):
+        return self._storage.idAllocator()
+
     def queryRange(self, start_date, end_date):
         return self._storage.list(start_date, end_date)
 
+    def iterRange(self, start_date, end_date):
+        return self._storage.iterRange(start_date, end_date)
+
+    # record tuples of the range in date order, a list per block.
+    def rangeTuples(self, start_date, end_date):
+        return self._storage.iterRangeTuples(start_date, end_date)
+
+    def summarize(self, start_date, end_date):
+        return self._storage.summarize(start_date, end_date)
+
+    # records of the range that match |filters|, in date order, see
+    # Storage.iterFilteredTuples().
+    def iterFiltered(self, start_date, end_date, filters):
+        return self._storage.iterFiltered(start_date, end_date, filters)
+
+    # the records of the range as a columns.ColumnSet, for reports.
+    def columns(self, start_date, end_date):
+        return self._storage.columns(start_date, end_date)
+
     def findById(self, recId):
         return self._storage.findById(recId)
 
+    # id -> record for the ids of |recIds| that are found, reading each
+    # block once.
+    def findByIds(self, recIds):
+        return self._storage.findByIds(recIds)
+
+    # like findByIds(), for ids that must all be found: raises naming the
+    # missing ones otherwise.
+    def findAllByIds(self, recIds):
+        found = self.findByIds(recIds)
+        missing = [recId for recId in recIds if not recId in found]
+        if len(missing) == 1:
+            raise Exception("ID {} is not found.".format(missing[0]))
+        if len(missing) > 1:
+            raise Exception("IDs {} are not found."
+                            .format(", ".join(missing)))
+        return found
+
+    def search(self, text):
+        return self._storage.search(text)
+
     def allType(self):
         return self._storage.allType()
 
@@ -23,5 +76,125 @@ class CSBook:
     def allTag(self):
         return self._storage.allTag()
 
+    # usage counts and last seen timestamps of 'types', 'tags' or
+    # 'payments', for ranking hints.
+    def usage(self, kind):
+        return self._storage.vocabulary().usage(kind)
+
+    def compact(self):
+        return self._storage.compact()
+
+    def convert(self, binary):
+        return self._storage.convert(binary)
+
+    # compress the blocks that end before |before|, see Storage.archive().
+    def archive(self, before):
+        return self._storage.archive(before)
+
+    # keep the ledger in memory and answer the queries of other cs
+    # processes on the socket, until interrupted.
+    def serve(self):
+        from server import LedgerServer
+        self._storage.keepInMemory()
+        LedgerServer(self._storage, self._socketPath).serveForever()
+
+# A book whose queries are answered by a running 'cs serve'. Changes are
+# still written to the storage directly, and the server picks them up.
+# When the server goes away, queries fall back to the storage too.
+# iterFiltered(), search() and columns() aren't served: they always read
+# the storage.
+class RemoteCSBook(CSBook):
+    def __init__(self, storage, socketPath, client):
+        super().__init__(storage, socketPath)
+        self._client = client
+
+    # run |func| with the client, None if the server is gone.
+    def _remote(self, func):
+        if self._client == None:
+            return None
+        try:
+            return func(self._client)
+        except OSError:
+            self._client = None
+            return None
+
+    def _record(self, t):
+        return Record.createFromTuple(t, self._storage)
+
+    def queryRange(self, start_date, end_date):
+        chunks = self._remote(lambda c: list(c.range(start_date, end_date)))
+        if chunks == None:
+            return super().queryRange(start_date, end_date)
+        out = RecordSet()
+        for tuples in chunks:
+            for t in tuples:
+                out.insert(self._record(t), replace = False)
+        return out
+
+    def iterRange(self, start_date, end_date):
+        chunks = self._remote(lambda c: c.range(start_date, end_date))
+        if chunks == None:
+            return super().iterRange(start_date, end_date)
+        return (self._record(t) for tuples in chunks for t in tuples)
+
+    def rangeTuples(self, start_date, end_date):
+        chunks = self._remote(lambda c: c.range(start_date, end_date))
+        if chunks == None:
+            return super().rangeTuples(start_date, end_date)
+        return chunks
+
+    def summarize(self, start_date, end_date):
+        out = self._remote(lambda c: c.summarize(start_date, end_date))
+        if out == None:
+            return super().summarize(start_date, end_date)
+        return out
+
+    def findById(self, recId):
+        t = self._remote(lambda c: c.findById(recId))
+        if t != None:
+            return self._record(t)
+        if self._client == None:
+            return super().findById(recId)
+        return None
+
+    def findByIds(self, recIds):
+        found = self._remote(lambda c: c.findByIds(recIds))
+        if found == None:
+            return super().findByIds(recIds)
+        return { rId: self._record(t) for rId, t in found.items() }
+
+    def _names(self, kind, fallback):
+        out = self._remote(lambda c: c.names(kind))
+        return out if out != None else fallback()
+
+    def allType(self):
+        return self._names("types", super().allType)
+
+    def allPayment(self):
+        return self._names("payments", super().allPayment)
+
+    def allTag(self):
+        return self._names("tags", super().allTag)
+
+    def usage(self, kind):
+        out = self._remote(lambda c: c.usage(kind))
+        return out if out != None else super().usage(kind)
+
+    def serve(self):
+        raise Exception("cs serve is running already on {}"
+                        .format(self._socketPath))
+
+# The book of |config|, answered by 'cs serve' when it is running.
 def CSBookBuilder(config):
-    return CSBook(Storage(config.storagePath()))
+    storage = Storage(config.storagePath(),
+                      autoCompactRatio = config.autoCompactRatio(),
+                      workers = config.workers(),
+                      pool = config.workerPool(),
+                      fsync = config.fsync())
+    socketPath = config.socketPath()
+    if config.useServer() and os.path.exists(socketPath):
+        from client import LedgerClient
+        client = LedgerClient.connect(socketPath)
+        if client != None:
+            return RemoteCSBook(storage, socketPath, client)
+    return CSBook(storage, socketPath)
@@ -0,0 +1,18 @@
+import sys
+
+# Ids given to commands that take many of them, e.g. cs rm and cs edit.
+
+# the ids of |argv|, with '-' replaced by those read from stdin, separated
+# by whitespace, in the order given and without repeats.
+def readIds(argv):
+    out = []
+    seen = set()
+    for arg in argv:
+        ids = sys.stdin.read().split() if arg == "-" else [ arg ]
+        for recId in ids:
+            if not recId in seen:
+                seen.add(recId)
+                out.append(recId)
+    if len(out) < 1:
+        raise Exception("ID isn't specified")
+    return out
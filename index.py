@@ -0,0 +1,259 @@
+import instrument
+import json, os
+
+# Base class of the sidecar files that live next to the blocks and
+# summarize them. Each index remembers the state (size, mtime) of every
+# block it was built from; when those don't match the blocks on disk any
+# more, e.g. the file is missing or someone else appended to the ledger,
+# the index is rebuilt from scratch. Writers load, change and save the
+# indexes under Storage._indexLock(), so one's changes aren't lost to
+# another's.
+class SidecarIndex:
+    fileName = None
+    version = 1
+
+    def __init__(self, storage):
+        self._storage = storage
+        self._data = None
+
+    def path(self):
+        return self._storage.pathname(self.fileName)
+
+    # return the index content, loading or rebuilding it when needed.
+    def data(self):
+        if self._data == None:
+            self._data = self._load()
+            if self._data == None or \
+               self._data["blocks"] != self._storage.blockStates():
+                with instrument.phase("index.rebuild"):
+                    self._data = self.rebuild()
+                self.save()
+        return self._data
+
+    # forget the content if the blocks changed since it was loaded, e.g.
+    # another process appended to the ledger; it is loaded again when
+    # needed.
+    def refresh(self):
+        if self._data != None and \
+           self._data["blocks"] != self._storage.blockStates():
+            self._data = None
+
+    def _load(self):
+        try:
+            with open(self.path(), "r") as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if data.get("version") != self.version:
+            return None
+        return data
+
+    def save(self):
+        with instrument.phase("index.save"):
+            self._storage.writeAtomically(self.path(),
+                                          json.dumps(self._data))
+
+    def rebuild(self):
+        data = self.empty()
+        data["version"] = self.version
+        data["blocks"] = dict()
+        for block in self._storage.allBlocks():
+            recs = self._storage.loadBlock(block)
+            if recs != None:
+                for rec in recs.unsorted():
+                    if not rec.deleted():
+                        self.add(data, rec, block)
+        data["blocks"] = dict(self._storage.blockStates())
+        return data
+
+    # called by storage after records are appended to the blocks, with
+    # |changesByBlock|, a block -> [(previous, record)] dictionary, where
+    # previous is the live version the block had before, read under the
+    # lock, or None. The index is saved once.
+    def recordsInserted(self, changesByBlock):
+        data = self.data()
+        for block, changes in changesByBlock.items():
+            for prev, rec in changes:
+                if prev != None:
+                    self.remove(data, prev, block)
+                if not rec.deleted():
+                    self.add(data, rec, block)
+            data["blocks"][str(block)] = self._storage.blockState(block)
+        self.save()
+
+    # called by storage after |block| is rewritten without changing the
+    # live records in it, e.g. by compaction.
+    def blockRewritten(self, block):
+        data = self.data()
+        if self._storage.hasBlock(block):
+            data["blocks"][str(block)] = self._storage.blockState(block)
+        else:
+            data["blocks"].pop(str(block), None)
+        self.save()
+
+    # subclasses define the content of the index.
+    def empty(self):
+        return dict()
+
+    def add(self, data, rec, block):
+        raise NotImplementedError
+
+    def remove(self, data, rec, block):
+        raise NotImplementedError
+
+# Types, tags and payment methods ever used by live records, with the
+# number of records using each of them and the last date it was used.
+class VocabularyIndex(SidecarIndex):
+    fileName = "vocabulary.json"
+    kinds = {
+        "types":    lambda r: [ r.typ() ],
+        "tags":     lambda r: r.tags(),
+        "payments": lambda r: [ r.paymentMethod() ]
+    }
+
+    def empty(self):
+        return { k: dict() for k in self.kinds }
+
+    def add(self, data, rec, block):
+        ts = int(rec.date().timestamp())
+        for kind, accessFunc in self.kinds.items():
+            for v in set(accessFunc(rec)):
+                count, last = data[kind].get(v, (0, ts))
+                data[kind][v] = [count + 1, max(last, ts)]
+
+    # the last seen date is kept as is: it is only a hint for ranking.
+    def remove(self, data, rec, block):
+        for kind, accessFunc in self.kinds.items():
+            for v in set(accessFunc(rec)):
+                if not v in data[kind]:
+                    continue
+                data[kind][v][0] = data[kind][v][0] - 1
+                if data[kind][v][0] <= 0:
+                    del data[kind][v]
+
+    def names(self, kind):
+        return set(self.data()[kind].keys())
+
+    # value -> (count, last seen timestamp) of every value of |kind|.
+    def usage(self, kind):
+        return { v: tuple(entry) for v, entry in self.data()[kind].items() }
+
+# Ids that can't be found by decoding them, i.e. records that don't live in
+# the block of the date encoded in their id. Maps such an id to its block.
+class IdIndex(SidecarIndex):
+    fileName = "ids.json"
+
+    def empty(self):
+        return { "ids": dict() }
+
+    def add(self, data, rec, block):
+        if self._storage.blockOfId(rec.rId()) != block:
+            data["ids"][rec.rId()] = block
+
+    def remove(self, data, rec, block):
+        data["ids"].pop(rec.rId(), None)
+
+    def blockOf(self, recId):
+        return self.data()["ids"].get(recId)
+
+    def ids(self):
+        return self.data()["ids"].keys()
+
+# A rollup holds the totals of a set of records per currency, overall and
+# broken down by payment method, type and tag. Every total is kept as
+# [amount, count] so it can be dropped once no record contributes to it.
+ROLLUP_GROUPS = {
+    "payment": lambda r: [ r.paymentMethod() ],
+    "type":    lambda r: [ r.typ() ],
+    "tag":     lambda r: set(r.tags())
+}
+
+def emptyRollup():
+    out = { g: dict() for g in ROLLUP_GROUPS }
+    out["count"] = 0
+    out["total"] = dict()
+    return out
+
+def _addTotal(totals, currency, amount, count):
+    amt, n = totals.get(currency, (0.0, 0))
+    if n + count == 0:
+        totals.pop(currency, None)
+    else:
+        totals[currency] = [amt + amount, n + count]
+
+# add |rec| to |rollup|, or take it out when |sign| is -1.
+def addToRollup(rollup, rec, sign = 1):
+    amount = rec.amount() * sign
+    rollup["count"] = rollup["count"] + sign
+    _addTotal(rollup["total"], rec.currency(), amount, sign)
+    for g, accessFunc in ROLLUP_GROUPS.items():
+        for v in accessFunc(rec):
+            totals = rollup[g].setdefault(v, dict())
+            _addTotal(totals, rec.currency(), amount, sign)
+            if len(totals) == 0:
+                del rollup[g][v]
+
+def mergeRollup(rollup, other):
+    rollup["count"] = rollup["count"] + other["count"]
+    for cur, (amt, n) in other["total"].items():
+        _addTotal(rollup["total"], cur, amt, n)
+    for g in ROLLUP_GROUPS:
+        for v, totals in other[g].items():
+            for cur, (amt, n) in totals.items():
+                _addTotal(rollup[g].setdefault(v, dict()), cur, amt, n)
+    return rollup
+
+# Rollup of the live records of each block, kept in the block cache with
+# the state of the block it was made from, see BlockCache.derived(), so
+# that a write only touches the rollups of the blocks it changed. Writes
+# bring them up to date from the records they append; a block changed
+# otherwise, e.g. by another version of cs, is read again when its rollup
+# is next needed.
+class RollupIndex:
+    def __init__(self, storage):
+        self._storage = storage
+        self._blocks = dict() # block -> (state, rollup)
+
+    def _name(self, block):
+        return os.path.basename(
+            self._storage.pathnameByBlock(block)) + ".rollup"
+
+    # the rollup of |block|, None if it has no live record. It is shared,
+    # so it must not be modified.
+    def rollup(self, block):
+        state = self._storage.blockStates().get(str(block))
+        if state == None:
+            return None
+        memo = self._blocks.get(block)
+        if memo == None or memo[0] != state:
+            def build():
+                out = emptyRollup()
+                recs = self._storage.loadBlock(block)
+                for rec in recs.unsorted() if recs != None else []:
+                    if not rec.deleted():
+                        addToRollup(out, rec)
+                return out
+            with instrument.phase("index.rollup"):
+                memo = (state, self._storage._cache.derived(
+                    self._name(block), state, build))
+            self._blocks[block] = memo
+        return memo[1] if memo[1]["count"] > 0 else None
+
+    # store |rollup| as that of |block| as it is now.
+    def store(self, block, rollup):
+        state = self._storage.blockState(block)
+        self._storage._cache.storeDerived(self._name(block), state, rollup)
+        self._blocks[block] = (state, rollup)
+
+    # called by storage after appending to |block| with |changes|, see
+    # SidecarIndex.recordsInserted(); |before| is the rollup the block had
+    # before, as rollup() gave it.
+    def recordsInserted(self, block, before, changes):
+        out = mergeRollup(emptyRollup(), before) if before != None \
+              else emptyRollup()
+        for prev, rec in changes:
+            if prev != None:
+                addToRollup(out, prev, -1)
+            if not rec.deleted():
+                addToRollup(out, rec)
+        self.store(block, out)
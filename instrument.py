@@ -0,0 +1,89 @@
+import atexit, sys, time
+
+# Wall time and call counts of the phases of a command, printed when the
+# program exits. Turned on by enable(), e.g. through CS_PROFILE or the
+# --profile flag of cs; until then phase() hands out a shared no-op
+# context manager, so instrumented code costs a function call.
+#
+#   with instrument.phase("storage.read"):
+#       ...
+#
+# Phases can nest. Besides the total time of a phase, its own time is
+# kept: the total minus the time spent in phases nested in it.
+
+_enabled = False
+_phases = dict() # name -> [total seconds, own seconds, calls]
+_counters = dict() # name -> count
+_stack = [] # running phases
+
+class _NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_PHASE = _NullPhase()
+
+class _Phase:
+    __slots__ = ("_name", "_start", "_nested")
+
+    def __init__(self, name):
+        self._name = name
+
+    def __enter__(self):
+        self._nested = 0.0
+        _stack.append(self)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self._start
+        _stack.pop()
+        if len(_stack) > 0:
+            _stack[-1]._nested = _stack[-1]._nested + elapsed
+        entry = _phases.setdefault(self._name, [0.0, 0.0, 0])
+        entry[0] = entry[0] + elapsed
+        entry[1] = entry[1] + elapsed - self._nested
+        entry[2] = entry[2] + 1
+        return False
+
+def phase(name):
+    if not _enabled:
+        return _NULL_PHASE
+    return _Phase(name)
+
+def count(name, n = 1):
+    if _enabled:
+        _counters[name] = _counters.get(name, 0) + n
+
+# Start recording. With |profilePath|, the whole run is also profiled with
+# cProfile and the stats are dumped there.
+def enable(profilePath = None):
+    global _enabled
+    if _enabled:
+        return
+    _enabled = True
+    start = time.perf_counter()
+    atexit.register(lambda: report(time.perf_counter() - start))
+    if profilePath != None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        def dump():
+            profiler.disable()
+            profiler.dump_stats(profilePath)
+        atexit.register(dump)
+
+def report(wall, out = None):
+    out = out if out != None else sys.stderr
+    print("{:28} {:>8} {:>10} {:>10} {:>6}".format(
+        "phase", "calls", "total ms", "own ms", "own %"), file = out)
+    for name, (total, own, calls) in sorted(_phases.items(),
+                                            key = lambda p: -p[1][1]):
+        print("{:28} {:8} {:10.2f} {:10.2f} {:5.1f}%".format(
+            name, calls, total * 1000, own * 1000,
+            own * 100 / wall if wall > 0 else 0), file = out)
+    for name, n in sorted(_counters.items()):
+        print("{:28} {:8}".format(name, n), file = out)
+    print("{:28} {:8} {:10.2f}".format("wall", "", wall * 1000), file = out)
@@ -1,8 +1,24 @@
-import json, random, datetime
-import dateutil.parser
+import json, random, datetime, sys, collections
+import instrument
 random.seed()
 
+UTC = datetime.timezone.utc
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=UTC)
+
+def toMicroseconds(date):
+    return (date - EPOCH) // datetime.timedelta(microseconds = 1)
+
+# Records are kept in large numbers, so they have no __dict__ and share
+# their categorical strings (type, tags, payment method, currency) through
+# sys.intern(); decoders hand out interned strings, and tags are a tuple
+# that is shared with the stored version until the record is changed.
+# The date is kept as microseconds since 1970, which is what sorting and
+# filtering compare; the datetime is only made when asked for.
 class Record:
+    __slots__ = ("_storage", "_date", "_epoch", "_summary", "_type",
+                 "_tags", "_amount", "_paymentMethod", "_id", "_currency",
+                 "_deleted", "_origin")
+
     @classmethod
     def toBase36(cls, num):
         ch = "0123456789abcdefghijklmnopqrstuvwxyz"
@@ -15,31 +31,94 @@ class Record:
     @classmethod
     def createId(cls, date):
         return cls.toBase36(int(date.timestamp()) * 100 + random.randint(0, 99))
+
+    # An id of the second |ts| for which |isTaken| is false, None if
+    # every id of that second is taken.
+    @classmethod
+    def createUniqueId(cls, ts, isTaken):
+        start = random.randint(0, 99)
+        for i in range(100):
+            rId = cls.toBase36(ts * 100 + (start + i) % 100)
+            if not isTaken(rId):
+                return rId
+        return None
+
+    # reverse of createId(): the date the id was created for, or None if
+    # |recId| can't be an id.
+    @classmethod
+    def dateOfId(cls, recId):
+        try:
+            ts = int(recId, 36) // 100
+            return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc)
+        except (ValueError, OverflowError, OSError):
+            return None
         
     @classmethod
     def createFromDictionary(cls, dic, storage):
         out = cls(storage)
         out._date = dic["date"].astimezone(datetime.timezone.utc)
+        out._epoch = toMicroseconds(out._date)
         out._summary = dic["summary"]
-        out._type = dic["type"]
-        out._tags = dic["tags"]
+        out._type = sys.intern(dic["type"])
+        out._tags = tuple(sys.intern(t) for t in dic["tags"])
         out._amount = float(dic["amount"])
-        out._paymentMethod = dic["payment"]
-        out._currency = dic["currency"]
+        out._paymentMethod = sys.intern(dic["payment"])
+        out._currency = sys.intern(dic["currency"])
         out._id = dic["id"] if "id" in dic else cls.createId(out._date)
         out._deleted = dic["deleted"] if "deleted" in dic else False
         return out
 
+    # Dates are written by toJson() with isoformat(), which fromisoformat()
+    # reads back directly. dateutil is only needed, and imported, for lines
+    # that were written in some other format.
+    @classmethod
+    def parseDate(cls, text):
+        try:
+            return datetime.datetime.fromisoformat(text)
+        except ValueError:
+            instrument.count("record.dateutil_fallback")
+            import dateutil.parser
+            return dateutil.parser.parse(text)
+
     @classmethod
     def createFromJson(cls, jsonStr, storage):
         d = json.loads(jsonStr)
-        d["date"] = dateutil.parser.parse(d["date"])
-        return cls.createFromDictionary(d, storage)
+        return cls._createFromDecoded(d, jsonStr, storage)
+
+    @classmethod
+    def _createFromDecoded(cls, d, jsonStr, storage):
+        d["date"] = cls.parseDate(d["date"])
+        out = cls.createFromDictionary(d, storage)
+        out._origin = jsonStr
+        return out
+
+    # Records are also kept as plain tuples, e.g. in caches, which are
+    # cheaper to store and to turn back into records than json.
+    @classmethod
+    def createFromTuple(cls, t, storage):
+        out = cls(storage)
+        out._id, out._epoch, out._summary, out._type, out._tags, \
+            out._amount, out._currency, out._paymentMethod, out._deleted = t
+        out._origin = t
+        return out
+
+    # Decode a list of json lines with a single json.loads() call. When
+    # that fails, each line is decoded by itself so the error points to
+    # the bad line.
+    @classmethod
+    def createFromJsonLines(cls, lines, storage):
+        try:
+            dicts = json.loads("[" + ",".join(lines) + "]")
+        except ValueError:
+            return [cls.createFromJson(l, storage) for l in lines]
+        return [cls._createFromDecoded(d, l, storage)
+                for d, l in zip(dicts, lines)]
     
     def __init__(self, storage):
         self._storage = storage
 
         self._date = None
+        self._epoch = None
         self._summary = None
         self._type = None
         self._tags = None
@@ -49,9 +128,13 @@ class Record:
         self._currency = None
         self._deleted = None
 
+        # json or tuple of this record as it is in storage, None if never
+        # stored.
+        self._origin = None
+
     def toJson(self):
         return json.dumps({
-            "date": self._date.isoformat(),
+            "date": self.date().isoformat(),
             "summary": self._summary,
             "type": self._type,
             "tags": self._tags,
@@ -63,18 +146,47 @@ class Record:
             "deleted": self._deleted
         })
 
+    def toTuple(self):
+        return (self._id, self._epoch, self._summary,
+                self._type, tuple(self._tags), self._amount,
+                self._currency, self._paymentMethod, self._deleted)
+
     # modification
     def store(self):
         self._storage.insert(self)
+        self._origin = self.toJson()
 
     def delete(self):
         self._deleted = True
         self.store()
 
+    # a copy of the record as it is now, which was stored as this one was.
+    def snapshot(self):
+        out = Record.createFromTuple(self.toTuple(), self._storage)
+        out._origin = self._origin
+        return out
+
+    # store |recs| at once, see Storage.insertMany().
+    @classmethod
+    def storeMany(cls, recs, storage):
+        blocks = storage.insertMany(recs)
+        for rec in recs:
+            rec._origin = rec.toTuple()
+        return blocks
+
     # immutable properties
     def date(self):
+        if self._date == None:
+            # exact: microseconds since 1970 fit in a double for another
+            # couple of centuries.
+            self._date = datetime.datetime.fromtimestamp(
+                self._epoch / 1000000, UTC)
         return self._date
 
+    # the date in microseconds since 1970.
+    def epoch(self):
+        return self._epoch
+
     def rId(self):
         return self._id
 
@@ -84,6 +196,14 @@ class Record:
     def deleted(self):
         return self._deleted
 
+    # the version of this record that is currently in storage.
+    def stored(self):
+        if self._origin == None:
+            return None
+        if isinstance(self._origin, tuple):
+            return Record.createFromTuple(self._origin, self._storage)
+        return Record.createFromJson(self._origin, self._storage)
+
     # mutable properties
     def _assignIfSet(self, attr, exp_type, v):
         if isinstance(v, exp_type):
@@ -103,81 +223,106 @@ class Record:
         return self._assignIfSet("_paymentMethod", str, v)
 
     def tags(self, v = None):
-        return self._assignIfSet("_tags", list, v)
+        if isinstance(v, list):
+            self._tags = tuple(sys.intern(t) for t in v)
+        return list(self._tags)
 
     def addTag(self, v):
-        v = v.strip()
+        v = sys.intern(v.strip())
         if not v in self._tags:
-            self._tags.append(v)
+            self._tags = self._tags + (v,)
 
     def removeTag(self, v):
-        try: self._tags.remove(v)
-        except: pass
+        self._tags = tuple(t for t in self._tags if t != v)
 
 class RecordSet:
+    # values counted over the records of the set, by the name of the
+    # method that returns them.
+    counted = {
+        'types':    lambda r: (r._type,),
+        'tags':     lambda r: r._tags,
+        'payments': lambda r: (r._paymentMethod,)
+    }
+
     def __init__(self):
         self._pool = dict() # id -> obj dictionary
-        self._cache = dict()
-        self._resetCache()
-
-    def _resetCache(self):
-        self._cache['types'] = None
-        self._cache['tags'] = None
-        self._cache['payments'] = None
-
-    # helper function that get a value by iterating over pool and cache the
-    # result. |cacheName| is the properties that store the data. |accessFunc|
-    # defines a function, which takes a |record| and return a set that is
-    # to be merged into our result.
-    def _cachedPoolGetter(self, cacheName, accessFunc):
-        if self._cache[cacheName] == None:
-            out = set()
-            for rec in self._pool.values():
-                out = out | accessFunc(rec)
-            self._cache[cacheName] = out
-        return self._cache[cacheName]
-        
+        # name -> Counter of the values. Built in one pass when first asked
+        # for, then updated as records come and go, so records must not be
+        # changed while they are in the set.
+        self._counts = None
+
+    def _buildCounts(self):
+        if self._counts == None:
+            self._counts = dict()
+            for k, accessFunc in self.counted.items():
+                self._counts[k] = collections.Counter(
+                    v for rec in self._pool.values() for v in accessFunc(rec))
+        return self._counts
+
+    # add |n| to the counts of the values of |rec|.
+    def _count(self, rec, n):
+        if self._counts == None:
+            return
+        for k, accessFunc in self.counted.items():
+            counter = self._counts[k]
+            for v in accessFunc(rec):
+                counter[v] = counter[v] + n
+                if counter[v] <= 0:
+                    del counter[v]
+
     def insert(self, rec, replace):
         if (not replace) and (rec.rId() in self._pool):
             raise Exception("Given id is in the set already")
-        self._resetCache()
-        if rec.deleted() and rec.rId() in self._pool:
-            del self._pool[rec.rId()]
+        old = self._pool.get(rec.rId())
+        if old != None:
+            self._count(old, -1)
+        if rec.deleted():
+            self._pool.pop(rec.rId(), None)
         else:
             self._pool[rec.rId()] = rec
+            self._count(rec, 1)
 
     def combine(self, other):
-        self._resetCache()
-        for i in other._pool.values():
-            self.insert(i, False)
+        if not self._pool.keys().isdisjoint(other._pool.keys()):
+            raise Exception("Given id is in the set already")
+        self._pool.update(other._pool)
+        if self._counts != None:
+            for k, counter in other._buildCounts().items():
+                self._counts[k].update(counter)
 
     def filterDate(self, start_date, end_date):
-        self._resetCache()
+        with instrument.phase("recordset.filter"):
+            self._filterDate(start_date, end_date)
+
+    def _filterDate(self, start_date, end_date):
+        start = toMicroseconds(start_date)
+        end = toMicroseconds(end_date)
         new_pool = dict()
         for k, v in self._pool.items():
-            if v.date() < start_date:
-                continue
-            if v.date() > end_date:
+            if v._epoch < start or v._epoch > end:
+                self._count(v, -1)
                 continue
             new_pool[k] = v
         self._pool = new_pool
 
     def dateSorted(self):
-        return sorted(self._pool.values(),
-                      key = lambda x: x.date())
+        with instrument.phase("recordset.sort"):
+            return sorted(self._pool.values(),
+                          key = lambda x: x._epoch)
 
     def unsorted(self):
         return self._pool.values()
 
     def types(self):
-        return self._cachedPoolGetter('types',
-                                      lambda r: { r.typ() })
+        return set(self.counts('types'))
     def tags(self):
-        return self._cachedPoolGetter('tags',
-                                      lambda r: set(r.tags()))
+        return set(self.counts('tags'))
     def payments(self):
-        return self._cachedPoolGetter('payments',
-                                      lambda r: { r.paymentMethod() })
+        return set(self.counts('payments'))
+
+    # number of records using each value of |name|, e.g. 'tags'.
+    def counts(self, name):
+        return self._buildCounts()[name]
 
     def findById(self, recId):
         if recId in self._pool:
@@ -0,0 +1,245 @@
+import csv, datetime, functools, json, sys, unicodedata
+import dateutil.tz
+
+# Renderers of the output of cs view: the text layout and the machine
+# readable formats (json, csv, tsv). Output is collected and written in
+# large chunks instead of a write per line.
+
+DAY_US = 86400 * 1000000
+
+# Buffer in front of |out|: writes are joined and passed on once |size|
+# characters are collected, and on flush().
+class Output:
+    def __init__(self, out = None, size = 1 << 16):
+        self._out = out if out != None else sys.stdout
+        self._limit = size
+        self._parts = []
+        self._size = 0
+
+    def write(self, s):
+        self._parts.append(s)
+        self._size = self._size + len(s)
+        if self._size >= self._limit:
+            self.flush()
+
+    def flush(self):
+        if len(self._parts) > 0:
+            self._out.write("".join(self._parts))
+            self._parts = []
+            self._size = 0
+        self._out.flush()
+
+# Converts epochs to local time. The local timezone is looked up once, and
+# its utc offset once per day: a day that has a single offset, which is
+# almost every day, gets a fixed offset timezone; days with a transition
+# ask the local timezone for every epoch.
+class LocalTime:
+    def __init__(self, tz = None):
+        self._tz = tz if tz != None else dateutil.tz.tzlocal()
+        self._days = dict() # utc day -> timezone, False with a transition
+        self._zones = dict() # offset -> timezone
+
+    def tz(self):
+        return self._tz
+
+    def _zone(self, day):
+        zone = self._days.get(day)
+        if zone == None:
+            first = datetime.datetime.fromtimestamp(
+                day * 86400, self._tz).utcoffset()
+            last = datetime.datetime.fromtimestamp(
+                day * 86400 + 86399, self._tz).utcoffset()
+            zone = False
+            if first == last:
+                zone = self._zones.setdefault(first,
+                                              datetime.timezone(first))
+            self._days[day] = zone
+        return zone
+
+    # local time of |epoch|, microseconds since 1970.
+    def fromEpoch(self, epoch):
+        zone = self._zone(epoch // DAY_US)
+        return datetime.datetime.fromtimestamp(
+            epoch / 1000000, zone if zone != False else self._tz)
+
+# number of columns |text| takes on a terminal: East Asian wide and full
+# width characters take two.
+@functools.lru_cache(maxsize = 4096)
+def displayWidth(text):
+    if text.isascii():
+        return len(text)
+    return sum(2 if unicodedata.east_asian_width(c) in "WF" else 1
+               for c in text)
+
+# |text| padded with spaces to take |width| columns.
+def padToWidth(text, width):
+    return text + " " * max(0, width - displayWidth(text))
+
+class PerCurrencyCollector:
+    # |totals| is a currency -> [amount, count] dictionary of a rollup.
+    @classmethod
+    def fromTotals(cls, totals):
+        out = cls()
+        for crcy, (amt, n) in totals.items():
+            out.add(crcy, amt)
+        return out
+
+    def __init__(self):
+        self._sum = dict()
+
+    def add(self, crcy, amt):
+        if crcy in self._sum:
+            self._sum[crcy] = self._sum[crcy] + amt
+        else:
+            self._sum[crcy] = amt
+
+    def items(self):
+        return self._sum.items()
+
+    def summarize(self, indent=2):
+        out = ""
+        for cur, amt in self.items():
+            out = out + "{}{:10,.2f} {}\n".format(" "*indent, amt, cur)
+        return out
+
+# A renderer prints a list of records and a summary (an index.emptyRollup()
+# dictionary). |withSummary| tells whether the summary goes along with the
+# list.
+class Renderer:
+    withSummary = False
+
+    def __init__(self, out = None, localTime = None):
+        self._out = Output(out)
+        self._localTime = localTime if localTime != None else LocalTime()
+
+    # print |recs|, which are in date order, as they come.
+    def itemList(self, recs):
+        raise NotImplementedError
+
+    # print |rollup|; |detail| adds the breakdown by type and tag to the one
+    # by payment method.
+    def summary(self, rollup, detail = False):
+        raise NotImplementedError
+
+    def close(self):
+        self._out.flush()
+
+class TextRenderer(Renderer):
+    withSummary = True
+    item = """ * {:<6}{}
+   Summary:  {}
+   Tag:      {}
+   Pay with: {}
+   ID:       {}
+   {:73,.2f} {:3}
+
+"""
+
+    def _banner(self, title):
+        self._out.write("=" * 80 + "\n" + title + "\n" + "-" * 80 + "\n")
+
+    def itemList(self, recs):
+        write = self._out.write
+        fromEpoch = self._localTime.fromEpoch
+        self._banner("Item list")
+        cur_date = None
+        for rec in recs:
+            localtime = fromEpoch(rec.epoch())
+            if cur_date != localtime.date():
+                cur_date = localtime.date()
+                write(cur_date.strftime("%a %b %d, %Y") + "\n")
+            write(self.item.format(
+                "{:02}:{:02}".format(localtime.hour, localtime.minute),
+                "." * 71,
+                rec.summary(),
+                padToWidth(", ".join(rec.tags()), 53),
+                rec.paymentMethod(),
+                rec.rId(),
+                rec.amount(), rec.currency()))
+
+    def summary(self, rollup, detail = False):
+        write = self._out.write
+        self._banner("Summary")
+        groups = [("payment", "Payment method summary:")]
+        if detail:
+            groups = groups + [("type", "Type summary:"),
+                               ("tag", "Tag summary:")]
+        for g, title in groups:
+            write(title + "\n")
+            for v, totals in rollup[g].items():
+                write("  {}:\n".format(v))
+                write(PerCurrencyCollector.fromTotals(totals).summarize(4)
+                      + "\n")
+        write("-" * 80 + "\n")
+        write("Total:\n")
+        write(PerCurrencyCollector.fromTotals(rollup["total"]).summarize()
+              + "\n")
+
+# record fields in the machine readable formats, which are the fields
+# cs import reads.
+FIELDS = [ "id", "date", "summary", "type", "tags", "amount", "currency",
+           "payment" ]
+
+# Records as a json array of objects, the summary as the rollup object.
+class JsonRenderer(Renderer):
+    def itemList(self, recs):
+        write = self._out.write
+        fromEpoch = self._localTime.fromEpoch
+        sep = "[\n"
+        for rec in recs:
+            write(sep + json.dumps({
+                "id": rec.rId(),
+                "date": fromEpoch(rec.epoch()).isoformat(),
+                "summary": rec.summary(),
+                "type": rec.typ(),
+                "tags": rec.tags(),
+                "amount": rec.amount(),
+                "currency": rec.currency(),
+                "payment": rec.paymentMethod()
+            }, ensure_ascii = False))
+            sep = ",\n"
+        write("[]\n" if sep == "[\n" else "\n]\n")
+
+    def summary(self, rollup, detail = False):
+        self._out.write(json.dumps(rollup, ensure_ascii = False) + "\n")
+
+# Records as rows with a header, tags separated by ';'. The summary is a
+# row per group and currency: group (total, payment, type or tag), value,
+# currency, amount and count.
+class CsvRenderer(Renderer):
+    def __init__(self, out = None, localTime = None, delimiter = ","):
+        super().__init__(out, localTime)
+        self._writer = csv.writer(self._out, delimiter = delimiter,
+                                  lineterminator = "\n")
+
+    def itemList(self, recs):
+        fromEpoch = self._localTime.fromEpoch
+        self._writer.writerow(FIELDS)
+        self._writer.writerows(
+            (rec.rId(), fromEpoch(rec.epoch()).isoformat(), rec.summary(),
+             rec.typ(), ";".join(rec.tags()), rec.amount(), rec.currency(),
+             rec.paymentMethod()) for rec in recs)
+
+    def summary(self, rollup, detail = False):
+        self._writer.writerow([ "group", "value", "currency", "amount",
+                                "count" ])
+        for cur, (amt, n) in rollup["total"].items():
+            self._writer.writerow([ "total", "", cur, amt, n ])
+        for g in [ "payment", "type", "tag" ]:
+            for v, totals in rollup[g].items():
+                for cur, (amt, n) in totals.items():
+                    self._writer.writerow([ g, v, cur, amt, n ])
+
+FORMATS = {
+    "text": TextRenderer,
+    "json": JsonRenderer,
+    "csv":  CsvRenderer,
+    "tsv":  lambda out = None, localTime = None:
+                CsvRenderer(out, localTime, delimiter = "\t")
+}
+
+def makeRenderer(fmt, out = None, localTime = None):
+    if not fmt in FORMATS:
+        raise Exception("Format must be one of: {}"
+                        .format(", ".join(FORMATS)))
+    return FORMATS[fmt](out, localTime)
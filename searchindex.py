@@ -0,0 +1,100 @@
+import instrument
+import os, re
+
+# Search index of the summaries of live records: for every block, token ->
+# ids of the records of the block whose summary has it.
+#
+# A file per block, kept in the block cache with the state of the block it
+# was made from, see BlockCache.derived(). Writes don't touch the index: a
+# block that changed since is read and indexed again in full when
+# something is next searched for, which costs far less than rewriting an
+# index of the whole ledger on every insert would. Nothing is made until
+# the first search.
+
+# Words are runs of letters and digits. Chinese, Japanese and Korean text
+# isn't separated into words, so a run of those characters is indexed as
+# each of its characters and each pair of neighbouring characters: a query
+# of one character looks up the first, a longer one its pairs.
+CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff" \
+      "\uac00-\ud7af\U00020000-\U0002ffff"
+_wordMatcher = re.compile("([" + CJK + "]+)|[^\\W" + CJK + "]+")
+
+# |text| in the form it is indexed and searched in: compatibility forms,
+# e.g. full width letters, folded to the plain ones, and case folded.
+def normalizeText(text):
+    if text.isascii():
+        return text.lower()
+    import unicodedata
+    return unicodedata.normalize("NFKC", text).casefold()
+
+# search tokens of |text|; |query| gives the tokens a search for |text|
+# looks up, see _wordMatcher.
+def tokenize(text, query = False):
+    out = []
+    for m in _wordMatcher.finditer(normalizeText(text)):
+        run = m.group(1)
+        if run == None:
+            out.append(m.group(0))
+        elif query and len(run) > 1:
+            out.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            out.extend(run)
+            if not query:
+                out.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return out
+
+# runs of more than two CJK characters in |text|: their pairs may all be
+# in a summary without the run being there.
+def longRuns(text):
+    return [m.group(1) for m in _wordMatcher.finditer(normalizeText(text))
+            if m.group(1) != None and len(m.group(1)) > 2]
+
+class SearchIndex:
+    def __init__(self, storage):
+        self._storage = storage
+        self._blocks = dict() # block -> (state, tokens)
+
+    # name of the index of |block| in the block cache.
+    def _name(self, block):
+        return os.path.basename(
+            self._storage.pathnameByBlock(block)) + ".search"
+
+    # forget |block|, which was rewritten: its state may not tell.
+    def drop(self, block):
+        self._blocks.pop(block, None)
+        self._storage._cache.dropDerived(self._name(block))
+
+    # token -> ids of |block|, indexed again if the block changed.
+    def tokens(self, block):
+        state = self._storage.blockState(block)
+        memo = self._blocks.get(block)
+        if memo != None and memo[0] == state:
+            return memo[1]
+        def build():
+            with instrument.phase("search.index"):
+                tokens = dict()
+                recs = self._storage.loadBlock(block)
+                for rec in recs.unsorted() if recs != None else []:
+                    if not rec.deleted():
+                        for t in set(tokenize(rec.summary())):
+                            tokens.setdefault(t, set()).add(rec.rId())
+            return tokens
+        with instrument.phase("search.read"):
+            tokens = self._storage._cache.derived(self._name(block), state,
+                                                  build)
+        self._blocks[block] = (state, tokens)
+        return tokens
+
+    # id -> block of the records whose summary has every token of |text|.
+    def lookup(self, text):
+        query = set(tokenize(text, query = True))
+        out = dict()
+        if len(query) == 0:
+            return out
+        for block in self._storage.allBlocks():
+            tokens = self.tokens(block)
+            postings = sorted((tokens.get(t, ()) for t in query), key = len)
+            for rId in postings[0]:
+                if all(rId in p for p in postings[1:]):
+                    out[rId] = block
+        return out
@@ -0,0 +1,149 @@
+from client import LedgerClient, PROTOCOL_VERSION, readMessage, writeMessage
+from record import EPOCH
+from storage import blockStartDate
+import datetime, os, signal, socketserver, sys, threading
+
+# A long running process, started by 'cs serve', that keeps the decoded
+# blocks and the indexes of a ledger in memory and answers queries over a
+# unix domain socket. Other processes keep writing to the ledger directly;
+# before each request the server checks the blocks on disk and decodes
+# what was appended since.
+#
+# See client.py for the protocol.
+
+def _toDate(us):
+    return EPOCH + datetime.timedelta(microseconds = us)
+
+class _Handler(socketserver.StreamRequestHandler):
+    def _send(self, reply):
+        writeMessage(self.wfile, reply)
+
+    def handle(self):
+        while True:
+            req = readMessage(self.rfile)
+            if req == None:
+                return
+            try:
+                self.server.ledger.handle(req, self._send)
+            except (BrokenPipeError, ConnectionResetError):
+                return
+            except Exception as e:
+                self._send({ "error": str(e) })
+            self.wfile.flush()
+
+class _UnixServer(socketserver.ThreadingMixIn,
+                  socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class LedgerServer:
+    def __init__(self, storage, socketPath):
+        self._storage = storage
+        self._socketPath = socketPath
+        # the storage isn't thread safe; every request holds the lock
+        # while it uses it.
+        self._lock = threading.Lock()
+        self._ops = {
+            "hello":     self._hello,
+            "range":     self._range,
+            "summarize": self._summarize,
+            "find":      self._find,
+            "findMany":  self._findMany,
+            "names":     self._names,
+            "usage":     self._usage
+        }
+
+    def handle(self, req, send):
+        op = self._ops.get(req.get("op"))
+        if op == None:
+            raise Exception("Unknown request {}".format(req.get("op")))
+        op(req, send)
+
+    def _hello(self, req, send):
+        send({ "result": { "version": PROTOCOL_VERSION,
+                           "python": sys.version,
+                           "pid": os.getpid() } })
+
+    # the storage, checked against the blocks on disk.
+    def _fresh(self):
+        self._storage.refresh()
+        return self._storage
+
+    # the lock is taken per block, so a slow reader doesn't hold up the
+    # other clients.
+    def _range(self, req, send):
+        with self._lock:
+            blocks = self._fresh().iterRangeTuples(_toDate(req["start"]),
+                                                   _toDate(req["end"]))
+        while True:
+            with self._lock:
+                tuples = next(blocks, None)
+            if tuples == None:
+                break
+            send({ "records": tuples })
+        send({ "end": True })
+
+    def _summarize(self, req, send):
+        with self._lock:
+            rollup = self._fresh().summarize(_toDate(req["start"]),
+                                             _toDate(req["end"]))
+        send({ "result": rollup })
+
+    def _find(self, req, send):
+        with self._lock:
+            rec = self._fresh().findById(req["id"])
+        send({ "result": rec.toTuple() if rec != None else None })
+
+    def _findMany(self, req, send):
+        with self._lock:
+            recs = self._fresh().findByIds(req["ids"])
+        send({ "result": { rId: rec.toTuple()
+                           for rId, rec in recs.items() } })
+
+    def _names(self, req, send):
+        with self._lock:
+            names = self._fresh().vocabulary().names(req["kind"])
+        send({ "result": names })
+
+    def _usage(self, req, send):
+        with self._lock:
+            usage = self._fresh().vocabulary().usage(req["kind"])
+        send({ "result": usage })
+
+    # decode every block and load the indexes up front, so that the first
+    # requests are as fast as the next ones.
+    def warm(self):
+        with self._lock:
+            storage = self._fresh()
+            blocks = storage.allBlocks()
+            for block in blocks:
+                storage.loadBlock(block)
+            storage.vocabulary().data()
+            if len(blocks) > 0:
+                storage.summarize(blockStartDate(blocks[0]),
+                                  blockStartDate(blocks[-1] + 1))
+
+    # Serve until interrupted or terminated. A socket left behind by a
+    # server that is gone is replaced; a live server is an error.
+    def serveForever(self):
+        if LedgerClient.connect(self._socketPath) != None:
+            raise Exception("cs serve is running already on {}"
+                            .format(self._socketPath))
+        if os.path.exists(self._socketPath):
+            os.remove(self._socketPath)
+        self._storage.ensurePath(os.path.dirname(self._socketPath))
+        # only the owner of the ledger may connect.
+        umask = os.umask(0o077)
+        try:
+            server = _UnixServer(self._socketPath, _Handler)
+        finally:
+            os.umask(umask)
+        server.ledger = self
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            self.warm()
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.remove(self._socketPath)
@@ -1,21 +1,112 @@
-from record import Record, RecordSet
-import os, datetime, re
+from record import Record, RecordSet, toMicroseconds
+from index import VocabularyIndex, IdIndex, RollupIndex, \
+    emptyRollup, addToRollup, mergeRollup
+from binblock import BinaryBlock, writeBlock
+from blockcache import BlockCache
+from timeindex import TimeIndex
+from searchindex import SearchIndex, normalizeText, longRuns
+import instrument
+from array import array
+import bisect, contextlib, datetime, json, os, re, sys
+
+# fcntl is only on posix systems; elsewhere writes aren't locked.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 ## A file contains 10 days of data.
 BASEDATE = datetime.datetime(1984, 12, 21, tzinfo=datetime.timezone.utc)
 
 def blockNumber(date):
     return (date - BASEDATE).days//10
+
+def blockStartDate(block_number):
+    return BASEDATE + datetime.timedelta(days = block_number * 10)
     
 def fileNameByBlock(block_number):
     return "financial_{:08}.jsonl".format(block_number)
 
+def binaryFileNameByBlock(block_number):
+    return "financial_{:08}.bin".format(block_number)
+
+# an archived jsonl block, see Storage.archive().
+def compressedFileNameByBlock(block_number):
+    return fileNameByBlock(block_number) + ".gz"
+
+def blockRange(start_date, end_date):
+    return range(blockNumber(start_date), blockNumber(end_date) + 1)
+
+# how far back from the end of a block file to look for the last newline
+# when repairing an unfinished line.
+TAIL_SCAN = 1 << 16
+
 def fileNameGenerator(start_date, end_date):
-    first_block = blockNumber(start_date)
-    last_block = blockNumber(end_date)
-    while first_block <= last_block:
-        yield fileNameByBlock(first_block)
-        first_block = first_block + 1
+    for block in blockRange(start_date, end_date):
+        yield fileNameByBlock(block)
+
+# Runs in the worker processes of Storage.list().
+def _loadBlockTuplesAt(path, block_number, start_date, end_date):
+    return Storage(path)._loadBlockTuples(block_number, start_date, end_date)
+
+# Fields that records can be filtered by, see Storage.iterFiltered(), and
+# their index in record tuples.
+FILTER_FIELDS = {
+    "type":    3,
+    "tag":     4,
+    "payment": 7
+}
+
+# int with bit i set for every i in |rows|, |n| rows in all.
+def rowBitmap(rows, n):
+    out = bytearray((n + 7) // 8)
+    for i in rows:
+        out[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(out, "little")
+
+# indexes of the bits set in |bitmap|, in increasing order.
+def bitmapRows(bitmap):
+    bits = bin(bitmap)[:1:-1]
+    return [i for i, b in enumerate(bits) if b == "1"]
+
+# Hands out ids that no record in the ledger uses, tombstones included,
+# and that weren't handed out or reserved before. The ids of a block are
+# read when an id of that block is first asked about.
+#
+# An id encodes its second and one of 100 suffixes. When every id of a
+# second is taken, the next seconds are tried, so in a dense batch an id
+# may decode to a later date than its record's; the id index keeps track
+# of those that end up in another block.
+class IdAllocator:
+    def __init__(self, storage):
+        self._storage = storage
+        self._blocks = dict() # block -> ids in it
+        self._used = set(storage.movedIds())
+        self._next = dict() # second -> the first one that may have room
+
+    def taken(self, recId):
+        if recId in self._used:
+            return True
+        block = self._storage.blockOfId(recId)
+        if block == None:
+            return False
+        if not block in self._blocks:
+            self._blocks[block] = self._storage.idsInBlock(block)
+        return recId in self._blocks[block]
+
+    def reserve(self, recId):
+        self._used.add(recId)
+
+    def allocate(self, date):
+        start = int(date.timestamp())
+        ts = self._next.get(start, start)
+        recId = Record.createUniqueId(ts, self.taken)
+        while recId == None:
+            ts = ts + 1
+            recId = Record.createUniqueId(ts, self.taken)
+        self._next[start] = ts
+        self.reserve(recId)
+        return recId
 
 class Storage:
     @classmethod
@@ -25,76 +116,912 @@ class Storage:
         if os.path.isfile(path):
             # cannot be a file
             raise Exception("{} is a file".format(path))
-        os.makedirs(path)
+        # another process may be creating it too.
+        os.makedirs(path, exist_ok = True)
 
-    def __init__(self, path):
-        self.ensurePath(path)
+    # |fsync|: flush the data to the disk before it replaces |path|, for
+    # files that hold records; the directory is left to the caller.
+    @classmethod
+    def writeAtomically(cls, path, data, fsync = False):
+        cls.ensurePath(os.path.dirname(path))
+        # a name of its own, as other processes may write the same file.
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, "wb" if isinstance(data, bytes) else "w") as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    # |autoCompactRatio|: when set, a block is compacted after an edit or
+    # delete leaves more than this fraction of its lines dead.
+    # |workers|: when more than 1, list() decodes blocks with that many
+    # workers, processes or threads depending on |pool|.
+    # |fsync|: whether appends are flushed to the disk before insert()
+    # returns, once per block written.
+    # The directory is only created when something is written to it.
+    def __init__(self, path, autoCompactRatio = None,
+                 workers = None, pool = "process", fsync = True):
         self._path = path
+        self._autoCompactRatio = autoCompactRatio
+        self._workers = workers
+        self._pool = pool
+        self._fsync = fsync
+        self._pending = None
+        self._indexLockDepth = 0
+        self._states = None
+        self._memory = None
+        self._cache = BlockCache(self)
+        self._timeIndex = TimeIndex(self)
+        self._vocabulary = VocabularyIndex(self)
+        self._ids = IdIndex(self)
+        self._rollups = RollupIndex(self)
+        self._indexes = [ self._vocabulary, self._ids ]
+        self._search = SearchIndex(self)
 
     def pathnameByBlock(self, block_number):
         return os.path.join(self._path, fileNameByBlock(block_number))
 
+    def binaryPathnameByBlock(self, block_number):
+        return os.path.join(self._path, binaryFileNameByBlock(block_number))
+
+    def compressedPathnameByBlock(self, block_number):
+        return os.path.join(self._path,
+                            compressedFileNameByBlock(block_number))
+
     def pathnameByDate(self, date):
         return self.pathnameByBlock(blockNumber(date))
 
     def pathname(self, fn):
         return os.path.join(self._path, fn)
     
-    def _loadRecordsFromFile(self, fn):
-        try:
-            out = RecordSet()
-            with open(fn, "r") as f:
-                while True:
-                    line = f.readline()
-                    if line == "":
-                        break
-                    out.insert(Record.createFromJson(line.strip(), self),
-                               replace = True)
-            return out
-        except FileNotFoundError:
+    # replay the lines of |fn| into |pool|, an id -> record tuple
+    # dictionary, or a new one. Lines that were decoded before come from
+    # the block cache.
+    def _loadRecordsFromFile(self, fn, pool = None):
+        lines = self._cache.load(fn)
+        if lines == None:
+            return pool
+        pool = pool if pool != None else dict()
+        for rId, t in lines.items():
+            if t[8]: # deleted
+                pool.pop(rId, None)
+            else:
+                pool[rId] = t
+        return pool
+
+    # like _loadRecordsFromFile(), for the records of |fn| in a date range
+    # only, which are found through the time index when that is cheaper.
+    def _loadRangeFromFile(self, fn, pool, start_date, end_date):
+        found = self._timeIndex.rangeTuples(fn, toMicroseconds(start_date),
+                                            toMicroseconds(end_date),
+                                            withIds = pool != None)
+        if found == None:
+            return self._loadRecordsFromFile(fn, pool)
+        tuples, ids = found
+        if pool != None:
+            for rId in ids:
+                pool.pop(rId, None)
+        pool = pool if pool != None else dict()
+        for t in tuples:
+            pool[t[0]] = t
+        return pool
+
+    # A block is a binary file, a jsonl file or both, in which case the
+    # jsonl lines are changes made after the binary file was written. The
+    # jsonl lines of an archived block are in a compressed file, which is
+    # replayed before the jsonl file, if there is one too.
+    # With a date range, only the matching rows of the binary file are
+    # read, and when the range covers only part of the block, only the
+    # matching lines of the jsonl file. Returns the live records as an
+    # id -> tuple dictionary, None if the block doesn't exist; with a
+    # range, records outside of it may or may not be there.
+    def _loadBlockTuples(self, block_number, start_date = None,
+                         end_date = None):
+        if self._memory != None:
+            return self._loadBlockTuplesInMemory(block_number)
+        return self._readBlockTuples(block_number, start_date, end_date)
+
+    def _readBlockTuples(self, block_number, start_date = None,
+                         end_date = None):
+        pool = None
+        path = self.binaryPathnameByBlock(block_number)
+        if os.path.isfile(path):
+            with instrument.phase("storage.decode_binary"):
+                pool = { t[0]: t for t in
+                         BinaryBlock(path).tuples(start_date, end_date) }
+        pool = self._loadRecordsFromFile(
+            self.compressedPathnameByBlock(block_number), pool)
+        fn = self.pathnameByBlock(block_number)
+        if start_date != None and \
+           (blockStartDate(block_number) < start_date or
+            end_date + datetime.timedelta(microseconds = 1) <
+            blockStartDate(block_number + 1)):
+            return self._loadRangeFromFile(fn, pool, start_date, end_date)
+        return self._loadRecordsFromFile(fn, pool)
+
+    # Keep decoded blocks in memory, for a long running process. A block is
+    # read again only when its files changed, and then only the lines
+    # appended to the jsonl file are decoded.
+    def keepInMemory(self):
+        self._memory = dict() # block -> (state, id -> tuple)
+        self._cache = BlockCache(self, memory = True)
+
+    # forget the state of the directory, for a long running process that
+    # shares it with others. Indexes that don't match the blocks any more
+    # are loaded again when needed.
+    def refresh(self):
+        self._states = None
+        for idx in self._indexes:
+            idx.refresh()
+
+    # The pool of a block in memory is shared by every caller, so it must
+    # not be modified.
+    def _loadBlockTuplesInMemory(self, block_number):
+        state = self.blockState(block_number)
+        memo = self._memory.get(block_number)
+        if memo != None and memo[0] == state:
+            return memo[1]
+        pool = self._readBlockTuples(block_number)
+        self._memory[block_number] = (state, pool)
+        return pool
+
+    def loadBlock(self, block_number, start_date = None, end_date = None):
+        pool = self._loadBlockTuples(block_number, start_date, end_date)
+        if pool == None:
             return None
+        out = RecordSet()
+        for t in pool.values():
+            out.insert(Record.createFromTuple(t, self), replace = True)
+        return out
 
     # Help function that collect all different values which are accessed
-    # through reccord.|prop|() method.
+    # through reccord.|prop|() method. The values come from the vocabulary
+    # index, so blocks are only read when the index has to be rebuilt.
     def _collectAll(self, prop):
-        out = set()
-        for i in self._allFilesIterator():
-            recs = self._loadRecordsFromFile(i)
-            if recs != None:
-                out = out | getattr(recs, prop)()
-        return out
+        return self._vocabulary.names(prop)
     
     def _allFilesIterator(self):
-        files = os.listdir(self._path)
-        matcher = re.compile(r'^financial_\d{8}.jsonl$')
+        with instrument.phase("storage.listdir"):
+            try:
+                files = os.listdir(self._path)
+            except FileNotFoundError:
+                files = []
+        matcher = re.compile(r'^financial_\d{8}\.(jsonl|jsonl\.gz|bin)$')
         for i in files:
             if matcher.match(i) != None and \
                os.path.isfile(os.path.join(self._path, i)):
                 yield os.path.join(self._path, i)
+
+    def allBlocks(self):
+        out = set()
+        for i in self._allFilesIterator():
+            out.add(int(os.path.basename(i)[10:18]))
+        return sorted(out)
+
+    def hasBlock(self, block_number):
+        return os.path.isfile(self.pathnameByBlock(block_number)) or \
+            os.path.isfile(self.binaryPathnameByBlock(block_number)) or \
+            os.path.isfile(self.compressedPathnameByBlock(block_number))
+
+    def blockState(self, block_number):
+        out = []
+        for path in [ self.pathnameByBlock(block_number),
+                      self.binaryPathnameByBlock(block_number),
+                      self.compressedPathnameByBlock(block_number) ]:
+            try:
+                st = os.stat(path)
+                out.extend([st.st_size, st.st_mtime_ns])
+            except FileNotFoundError:
+                out.extend([0, 0])
+        return out
+
+    # state of all blocks, which is what indexes are checked against.
+    # Scanned once and then kept up to date by insert().
+    def blockStates(self):
+        if self._states == None:
+            self._states = { str(b): self.blockState(b)
+                             for b in self.allBlocks() }
+        return self._states
+
+    def vocabulary(self):
+        return self._vocabulary
     
     def insert(self, rec):
-        # find file, append.
-        with open(self.pathnameByDate(rec.date()), "a") as f:
-            f.write(rec.toJson() + "\n")
+        if self._pending != None:
+            self._pending.append(rec.snapshot())
+            return
+        self.insertMany([rec])
+
+    # Group commit: records inserted while it is open are queued, and
+    # written by insertMany() when it closes, with one locked write and one
+    # fsync per block. Reads don't see them until then, and nothing is
+    # written if the body raises.
+    @contextlib.contextmanager
+    def groupCommit(self):
+        if self._pending != None:
+            yield
+            return
+        self._pending = []
+        try:
+            yield
+            pending = self._pending
+        finally:
+            self._pending = None
+        if len(pending) > 0:
+            self.insertMany(pending)
+
+    # Lock of the indexes of the ledger against other cs processes, held by
+    # everything that changes blocks, from loading the indexes to saving
+    # them; otherwise the last writer's index would win, with the states of
+    # blocks that have the others' lines too, and never be rebuilt. The
+    # indexes are loaded again under it. Taken before any block lock, and
+    # may be nested.
+    @contextlib.contextmanager
+    def _indexLock(self):
+        if self._indexLockDepth > 0 or fcntl == None:
+            self._indexLockDepth = self._indexLockDepth + 1
+            try:
+                yield
+            finally:
+                self._indexLockDepth = self._indexLockDepth - 1
+            return
+        self.ensurePath(self._path)
+        with open(self.pathname("index.lock"), "a+b") as f:
+            with instrument.phase("storage.lock"):
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            self._indexLockDepth = 1
+            try:
+                self.refresh()
+                yield
+            finally:
+                self._indexLockDepth = 0
+
+    # The jsonl file of |block|, opened for appending and locked against
+    # other cs processes. A file that was replaced while waiting for the
+    # lock, e.g. by a compaction, is opened again. An archived block is
+    # made plain jsonl again first, unless |reopen| is False. The lock is
+    # released when the file is closed.
+    @contextlib.contextmanager
+    def _lockedBlockFile(self, block_number, reopen = True):
+        path = self.pathnameByBlock(block_number)
+        while True:
+            f = open(path, "a+b")
+            if fcntl != None:
+                with instrument.phase("storage.lock"):
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                try:
+                    same = os.path.samestat(os.fstat(f.fileno()),
+                                            os.stat(path))
+                except FileNotFoundError:
+                    same = False
+                if not same:
+                    f.close()
+                    continue
+            if reopen and \
+               os.path.isfile(self.compressedPathnameByBlock(block_number)):
+                self._decompressBlock(block_number, f)
+                f.close()
+                continue
+            break
+        try:
+            yield f
+        finally:
             f.close()
 
+    # A writer that died in the middle of an append leaves a line without
+    # its newline at the end of |f|. Such a line is dropped, unless it
+    # holds a whole record, in which case only the newline was missing.
+    def _repairTail(self, f):
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        f.seek(max(0, size - TAIL_SCAN))
+        data = f.read()
+        if data.endswith(b"\n"):
+            return
+        end = data.rfind(b"\n") + 1
+        try:
+            json.loads(data[end:])
+            f.write(b"\n")
+            return
+        except ValueError:
+            pass
+        if end == 0 and size > TAIL_SCAN:
+            # too long to be a record; keep it on a line of its own, which
+            # the loader skips.
+            f.write(b"\n")
+        else:
+            f.truncate(size - len(data) + end)
+        instrument.count("storage.torn_tail")
+        print("warning: dropped an unfinished line at the end of {}"
+              .format(f.name), file = sys.stderr)
+
+    def _fsyncDirectory(self):
+        fd = os.open(self._path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    # Append |recs| with a single locked write per block, and update every
+    # index once. Records with the same id are applied in order. Returns
+    # the number of blocks written.
+    def insertMany(self, recs):
+        with self._indexLock():
+            return self._insertMany(recs)
+
+    def _insertMany(self, recs):
+        # bring indexes up to date before the blocks change under them.
+        for idx in self._indexes:
+            idx.data()
+        recsByBlock = dict()
+        for rec in recs:
+            recsByBlock.setdefault(blockNumber(rec.date()), []).append(rec)
+        # find files, append.
+        self.ensurePath(self._path)
+        changesByBlock = dict()
+        for block, blockRecs in sorted(recsByBlock.items()):
+            data = "".join(r.toJson() + "\n" for r in blockRecs)
+            created = not os.path.exists(self.pathnameByBlock(block))
+            with self._lockedBlockFile(block) as f:
+                self._repairTail(f)
+                changesByBlock[block] = self._changes(block, blockRecs)
+                rollup = self._rollups.rollup(block)
+                with instrument.phase("storage.append"):
+                    f.write(data.encode("utf-8"))
+                    f.flush()
+                if self._fsync:
+                    with instrument.phase("storage.fsync"):
+                        os.fsync(f.fileno())
+            if created and self._fsync:
+                self._fsyncDirectory()
+            # keep the time index up to date, if the block has one.
+            if self._timeIndex.exists(self.pathnameByBlock(block)):
+                self._timeIndex.load(self.pathnameByBlock(block))
+            if self._states != None:
+                self._states[str(block)] = self.blockState(block)
+            self._rollups.recordsInserted(block, rollup,
+                                          changesByBlock[block])
+        for idx in self._indexes:
+            idx.recordsInserted(changesByBlock)
+        # only edits and deletes leave dead lines behind.
+        if self._autoCompactRatio != None:
+            for block, changes in sorted(changesByBlock.items()):
+                if all(prev == None for prev, rec in changes):
+                    continue
+                lines, live = self._blockUsage(block)
+                if lines > 0 and \
+                   (lines - len(live)) / lines > self._autoCompactRatio:
+                    self._compactBlock(block)
+        return len(recsByBlock)
+
+    # (previous, record) for each of |recs|, about to be appended to
+    # |block|: previous is the live version of the record in the block as
+    # it is on disk, or as an earlier one of |recs| left it, None if there
+    # is none. What this process loaded before may be stale, as other
+    # processes write too, so the block is read under its lock.
+    def _changes(self, block_number, recs):
+        pool = self._loadBlockTuples(block_number) or dict()
+        current = dict()
+        out = []
+        for rec in recs:
+            t = current[rec.rId()] if rec.rId() in current else \
+                pool.get(rec.rId())
+            prev = Record.createFromTuple(t, self) if t != None else None
+            out.append((prev, rec))
+            current[rec.rId()] = None if rec.deleted() else rec.toTuple()
+        return out
+
+    # every id in |block|, tombstones included.
+    def idsInBlock(self, block_number):
+        out = set()
+        path = self.binaryPathnameByBlock(block_number)
+        if os.path.isfile(path):
+            out.update(t[0] for t in BinaryBlock(path).tuples())
+        for fn in [ self.compressedPathnameByBlock(block_number),
+                    self.pathnameByBlock(block_number) ]:
+            lines = self._cache.load(fn)
+            if lines != None:
+                out.update(lines.keys())
+        return out
+
+    def idAllocator(self):
+        return IdAllocator(self)
+
+    # ids of records that live outside the block of their id.
+    def movedIds(self):
+        return self._ids.ids()
+
+    # number of lines (or binary rows) in |block| and its live records, in
+    # date order.
+    def _blockUsage(self, block_number):
+        recs = self.loadBlock(block_number)
+        if recs == None:
+            return 0, []
+        lines = 0
+        path = self.binaryPathnameByBlock(block_number)
+        if os.path.isfile(path):
+            lines = len(BinaryBlock(path))
+        try:
+            with open(self.pathnameByBlock(block_number), "rb") as f:
+                lines = lines + sum(1 for line in f if line.strip() != b"")
+        except FileNotFoundError:
+            pass
+        path = self.compressedPathnameByBlock(block_number)
+        if os.path.isfile(path):
+            import gzip
+            with gzip.open(path, "rb") as f:
+                lines = lines + sum(1 for line in f if line.strip() != b"")
+        return lines, [r for r in recs.dateSorted() if not r.deleted()]
+
+    # replace |block| with a single file, binary, jsonl or, with
+    # |compressed|, archived jsonl, holding |live|.
+    def _rewriteBlock(self, block_number, live, binary, compressed = False):
+        with self._indexLock():
+            self._rewriteBlockLocked(block_number, live, binary, compressed)
+
+    def _rewriteBlockLocked(self, block_number, live, binary, compressed):
+        for idx in self._indexes:
+            idx.data()
+        # the live records stay, so their rollup does too.
+        rollup = self._rollups.rollup(block_number)
+        path = self.pathnameByBlock(block_number)
+        binPath = self.binaryPathnameByBlock(block_number)
+        gzPath = self.compressedPathnameByBlock(block_number)
+        # the new file must be on the disk before the old ones are removed.
+        if len(live) > 0 and binary:
+            tmp = "{}.{}.tmp".format(binPath, os.getpid())
+            writeBlock(tmp, live)
+            if self._fsync:
+                with open(tmp, "rb") as f:
+                    os.fsync(f.fileno())
+            os.replace(tmp, binPath)
+        elif len(live) > 0 and compressed:
+            import gzip
+            tmp = "{}.{}.tmp".format(gzPath, os.getpid())
+            with instrument.phase("storage.compress"), open(tmp, "wb") as f:
+                with gzip.GzipFile(fileobj = f, mode = "wb", mtime = 0) as z:
+                    z.write("".join(r.toJson() + "\n" for r in live)
+                            .encode("utf-8"))
+                if self._fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp, gzPath)
+        elif len(live) > 0:
+            self.writeAtomically(path,
+                                 "".join(r.toJson() + "\n" for r in live),
+                                 fsync = self._fsync)
+        if len(live) > 0 and self._fsync:
+            self._fsyncDirectory()
+        kept = None if len(live) == 0 else \
+               binPath if binary else gzPath if compressed else path
+        for p in [ path, binPath, gzPath ]:
+            if p != kept and os.path.isfile(p):
+                os.remove(p)
+        if self._fsync:
+            self._fsyncDirectory()
+        self._cache.drop(path)
+        self._cache.drop(gzPath)
+        self._timeIndex.drop(path)
+        self._dropDerived(block_number)
+        if kept == path:
+            self._timeIndex.load(path)
+        if self._states != None:
+            if len(live) > 0:
+                self._states[str(block_number)] = self.blockState(block_number)
+            else:
+                self._states.pop(str(block_number), None)
+        if len(live) > 0 and rollup != None:
+            self._rollups.store(block_number, rollup)
+        for idx in self._indexes:
+            idx.blockRewritten(block_number)
+
+    # rewrite |block| to only the latest version of its live records,
+    # keeping it binary or archived if it was. The block is read again
+    # under the lock, so records appended meanwhile by other processes are
+    # kept. Returns the number of lines dropped.
+    def _compactBlock(self, block_number):
+        with self._indexLock(), \
+             self._lockedBlockFile(block_number, reopen = False):
+            lines, live = self._blockUsage(block_number)
+            binary = os.path.isfile(self.binaryPathnameByBlock(block_number))
+            compressed = os.path.isfile(
+                self.compressedPathnameByBlock(block_number))
+            self._rewriteBlock(block_number, live, binary, compressed)
+        return lines - len(live)
+
+    # Compact all blocks, or the given ones. Returns the number of blocks
+    # rewritten and the number of lines dropped.
+    def compact(self, blocks = None):
+        rewritten = 0
+        dropped = 0
+        for block in (blocks if blocks != None else self.allBlocks()):
+            lines, live = self._blockUsage(block)
+            if lines == len(live):
+                continue
+            dropped = dropped + self._compactBlock(block)
+            rewritten = rewritten + 1
+        return rewritten, dropped
+
+    # Convert all blocks to the binary format, or back to jsonl. Blocks are
+    # compacted on the way. Returns the number of blocks converted.
+    def convert(self, binary):
+        converted = 0
+        for block in self.allBlocks():
+            hasBin = os.path.isfile(self.binaryPathnameByBlock(block))
+            hasJson = os.path.isfile(self.pathnameByBlock(block)) or \
+                os.path.isfile(self.compressedPathnameByBlock(block))
+            if (binary and not hasJson) or (not binary and not hasBin):
+                continue
+            with self._indexLock(), self._lockedBlockFile(block):
+                lines, live = self._blockUsage(block)
+                self._rewriteBlock(block, live, binary)
+            converted = converted + 1
+        return converted
+
+    # forget the search index, columns and bitmaps of |block|: a rewrite
+    # may leave its state as it was when the mtime is coarse.
+    def _dropDerived(self, block_number):
+        self._search.drop(block_number)
+        for suffix in [ ".columns", ".bitmaps" ]:
+            self._cache.dropDerived(fileNameByBlock(block_number) + suffix)
+
+    # the files of |block| were replaced without changing its records.
+    def _blockReplaced(self, block_number, paths):
+        for p in paths:
+            self._cache.drop(p)
+            self._timeIndex.drop(p)
+        self._dropDerived(block_number)
+        with self._indexLock():
+            if self._states != None:
+                if self.hasBlock(block_number):
+                    self._states[str(block_number)] = \
+                        self.blockState(block_number)
+                else:
+                    self._states.pop(str(block_number), None)
+            for idx in self._indexes:
+                idx.blockRewritten(block_number)
+
+    # Make an archived block plain jsonl again, for a write to it: the
+    # compressed lines, then those of |f|, the locked jsonl file, replace
+    # the jsonl file, and the compressed file is removed. Readers replay
+    # the compressed file before the jsonl one, so every step in between
+    # reads as the same records.
+    def _decompressBlock(self, block_number, f):
+        import gzip, shutil
+        for idx in self._indexes:
+            idx.data()
+        path = self.pathnameByBlock(block_number)
+        gzPath = self.compressedPathnameByBlock(block_number)
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with instrument.phase("storage.decompress"):
+            with open(tmp, "wb") as out:
+                with gzip.open(gzPath, "rb") as src:
+                    shutil.copyfileobj(src, out)
+                f.seek(0)
+                shutil.copyfileobj(f, out)
+                if self._fsync:
+                    out.flush()
+                    os.fsync(out.fileno())
+            os.replace(tmp, path)
+            os.remove(gzPath)
+        if self._fsync:
+            self._fsyncDirectory()
+        self._blockReplaced(block_number, [ path, gzPath ])
+
+    # Compact the jsonl blocks that end before |before| into compressed
+    # files, which are then read by decompressing them as a stream. Blocks
+    # with a binary file are left as they are. A block that is written to
+    # again is made plain jsonl first. Returns the number of blocks
+    # archived and their size before and after.
+    def archive(self, before):
+        archived = 0
+        size = 0
+        compressed = 0
+        for block in self.allBlocks():
+            path = self.pathnameByBlock(block)
+            gzPath = self.compressedPathnameByBlock(block)
+            if blockStartDate(block + 1) > before or \
+               not os.path.isfile(path) or \
+               os.path.isfile(self.binaryPathnameByBlock(block)):
+                continue
+            with self._indexLock(), \
+                 self._lockedBlockFile(block, reopen = False) as f:
+                self._repairTail(f)
+                # a compressed file too was left by an archive that didn't
+                # finish; its records are kept.
+                for p in [ path, gzPath ]:
+                    if os.path.isfile(p):
+                        size = size + os.path.getsize(p)
+                lines, live = self._blockUsage(block)
+                self._rewriteBlock(block, live, False, compressed = True)
+            archived = archived + 1
+            if os.path.isfile(gzPath):
+                compressed = compressed + os.path.getsize(gzPath)
+        return archived, size, compressed
+
+    # Decode the blocks in worker processes or threads. map() keeps the
+    # order of |blocks|, so the result doesn't depend on the scheduling,
+    # and yields each block as soon as it and those before it are done.
+    def _loadBlockTuplesInParallel(self, blocks, start_date, end_date):
+        import concurrent.futures
+        n = len(blocks)
+        if self._pool == "thread":
+            executor = concurrent.futures.ThreadPoolExecutor(self._workers)
+            func = self._loadBlockTuples
+            args = [blocks, [start_date] * n, [end_date] * n]
+        else:
+            executor = concurrent.futures.ProcessPoolExecutor(self._workers)
+            func = _loadBlockTuplesAt
+            args = [[self._path] * n, blocks, [start_date] * n,
+                    [end_date] * n]
+        try:
+            yield from executor.map(func, *args,
+                                    chunksize = max(1, n // self._workers))
+        finally:
+            # a reader that stops early doesn't wait for the rest.
+            executor.shutdown(cancel_futures = True)
+
+    # the tuple pools of the blocks of the range, in block order, see
+    # _loadBlockTuples(); decoded by the workers, if there are any.
+    def _rangePools(self, start_date, end_date):
+        blocks = list(blockRange(start_date, end_date))
+        if self._workers != None and self._workers > 1 and \
+           len(blocks) > 1 and self._memory == None:
+            return self._loadBlockTuplesInParallel(blocks,
+                                                   start_date, end_date)
+        return (self._loadBlockTuples(b, start_date, end_date)
+                for b in blocks)
+
     def list(self, start_date, end_date):
         out = RecordSet()
-        for fn in fileNameGenerator(start_date, end_date):
-            recs = self._loadRecordsFromFile(self.pathname(fn))
-            if recs != None:
-                out.combine(recs)
+        for pool in self._rangePools(start_date, end_date):
+            if pool != None:
+                with instrument.phase("recordset.merge"):
+                    for t in pool.values():
+                        out.insert(Record.createFromTuple(t, self),
+                                   replace = False)
         out.filterDate(start_date, end_date)
         return out
 
+    # tuples of the live records of |block| in the range, in date order,
+    # None if there's no such block.
+    def _sortedBlockTuples(self, block_number, start_date, end_date):
+        return self._sortedPool(
+            self._loadBlockTuples(block_number, start_date, end_date),
+            start_date, end_date)
+
+    # tuples of |pool| in the range, in date order, None if |pool| is.
+    def _sortedPool(self, pool, start_date, end_date):
+        if pool == None:
+            return None
+        start = toMicroseconds(start_date)
+        end = toMicroseconds(end_date)
+        with instrument.phase("storage.sort"):
+            return sorted((t for t in pool.values() if start <= t[1] <= end),
+                          key = lambda t: t[1])
+
+    # Tuples of the live records of the range in date order, a list per
+    # block, handed out as each block is decoded, see _rangePools().
+    # Blocks are in date order already, so only their own records need to
+    # be sorted.
+    def iterRangeTuples(self, start_date, end_date):
+        for pool in self._rangePools(start_date, end_date):
+            tuples = self._sortedPool(pool, start_date, end_date)
+            if tuples != None:
+                yield tuples
+
+    # The live records of the range as a columns.ColumnSet, for reports.
+    # The columns of blocks that are entirely in the range are cached
+    # until the block changes; only the blocks at the edges are decoded.
+    def columns(self, start_date, end_date, useNumpy = None):
+        from columns import ColumnSet
+        out = ColumnSet(useNumpy)
+        for block in blockRange(start_date, end_date):
+            blockStart = blockStartDate(block)
+            blockEnd = blockStartDate(block + 1) - \
+                datetime.timedelta(microseconds = 1)
+            if start_date <= blockStart and blockEnd <= end_date:
+                if not self.hasBlock(block):
+                    continue
+                def build():
+                    cols = ColumnSet(False)
+                    cols.extend(self._sortedBlockTuples(block, blockStart,
+                                                        blockEnd))
+                    return cols.dump()
+                with instrument.phase("storage.columns"):
+                    data = self._cache.derived(
+                        fileNameByBlock(block) + ".columns",
+                        self.blockState(block), build)
+                    out.append(ColumnSet.load(data, False))
+                continue
+            tuples = self._sortedBlockTuples(block, start_date, end_date)
+            if tuples != None:
+                out.extend(tuples)
+        return out
+
+    # Live records of the range in date order.
+    def iterRange(self, start_date, end_date):
+        for tuples in self.iterRangeTuples(start_date, end_date):
+            yield from [Record.createFromTuple(t, self) for t in tuples]
+
+    # Bitmaps of the live records of |pool|, the tuples of |block|, kept in
+    # the cache until the block changes: the ids, joined by newlines, and
+    # the epochs of the records by date, and for every value of every
+    # field of FILTER_FIELDS, the bitmap of the records that have it.
+    # |fresh| makes them again rather than trusting the cache.
+    def _blockBitmaps(self, block_number, pool, fresh = False):
+        def build():
+            rows = sorted(pool.values(), key = lambda t: (t[1], t[0]))
+            found = { f: dict() for f in FILTER_FIELDS }
+            for i, t in enumerate(rows):
+                for f, col in FILTER_FIELDS.items():
+                    values = t[col] if f == "tag" else [ t[col] ]
+                    for v in values:
+                        found[f].setdefault(v, []).append(i)
+            return ("\n".join(t[0] for t in rows),
+                    array("q", (t[1] for t in rows)).tobytes(),
+                    { f: { v: rowBitmap(r, len(rows))
+                           for v, r in byValue.items() }
+                      for f, byValue in found.items() })
+        with instrument.phase("storage.bitmaps"):
+            if fresh:
+                return build()
+            out = self._cache.derived(fileNameByBlock(block_number) +
+                                      ".bitmaps",
+                                      self.blockState(block_number), build)
+            if len(out[1]) != len(pool) * 8:
+                out = build()
+        return out
+
+    # tuples of the records of |pool|, the tuples of |block|, in the range
+    # and with one of the values of every field of |filters|, by date.
+    def _filterBlock(self, block_number, pool, start, end, filters,
+                     fresh = False):
+        ids, epochs, bitmaps = self._blockBitmaps(block_number, pool, fresh)
+        epochs = array("q", epochs)
+        lo = bisect.bisect_left(epochs, start)
+        hi = bisect.bisect_right(epochs, end)
+        mask = ((1 << hi) - 1) >> lo << lo
+        for f, values in filters.items():
+            found = 0
+            for v in values:
+                found = found | bitmaps[f].get(v, 0)
+            mask = mask & found
+        if mask == 0:
+            return []
+        ids = ids.split("\n")
+        out = [pool.get(ids[i]) for i in bitmapRows(mask)]
+        if None in out and not fresh:
+            # the block changed without its state telling.
+            return self._filterBlock(block_number, pool, start, end,
+                                     filters, fresh = True)
+        return out
+
+    # Like iterRangeTuples(), for the records that match |filters|, a
+    # field -> values dictionary over FILTER_FIELDS: a record matches when
+    # it has one of the values of every field. Blocks whose rollup has
+    # none of them aren't read; in the others, the records are picked with
+    # the bitmaps of the values and the range before any is made.
+    def iterFilteredTuples(self, start_date, end_date, filters):
+        start = toMicroseconds(start_date)
+        end = toMicroseconds(end_date)
+        for block in blockRange(start_date, end_date):
+            rollup = self._rollups.rollup(block)
+            if rollup == None or \
+               not all(any(v in rollup[f] for v in values)
+                       for f, values in filters.items()):
+                continue
+            pool = self._loadBlockTuples(block)
+            if pool == None or len(pool) == 0:
+                continue
+            tuples = self._filterBlock(block, pool, start, end, filters)
+            if len(tuples) > 0:
+                yield tuples
+
+    def iterFiltered(self, start_date, end_date, filters):
+        for tuples in self.iterFilteredTuples(start_date, end_date, filters):
+            yield from [Record.createFromTuple(t, self) for t in tuples]
+
+    # Totals of the records in the range, see index.emptyRollup(). Blocks
+    # that are entirely in the range use their stored rollup; only the
+    # blocks at the edges are read.
+    def summarize(self, start_date, end_date):
+        out = emptyRollup()
+        for block in blockRange(start_date, end_date):
+            if start_date <= blockStartDate(block) and \
+               blockStartDate(block + 1) <= end_date:
+                rollup = self._rollups.rollup(block)
+                if rollup != None:
+                    mergeRollup(out, rollup)
+                continue
+            recs = self.loadBlock(block, start_date, end_date)
+            if recs == None:
+                continue
+            recs.filterDate(start_date, end_date)
+            for rec in recs.unsorted():
+                addToRollup(out, rec)
+        return out
+
+    # Live records whose summary has every word of |text|, in date order.
+    # The search index tells which records may match, so only their blocks
+    # are read; CJK text, which the index only has in pairs, is then
+    # checked in the summaries.
+    def search(self, text):
+        with instrument.phase("search.lookup"):
+            found = self._search.lookup(text)
+        byBlock = dict()
+        for rId, block in found.items():
+            byBlock.setdefault(block, []).append(rId)
+        runs = longRuns(text)
+        out = []
+        for block, ids in sorted(byBlock.items()):
+            pool = self._loadBlockTuples(block)
+            if pool == None:
+                continue
+            for rId in ids:
+                t = pool.get(rId)
+                if t == None:
+                    continue
+                if len(runs) > 0:
+                    summary = normalizeText(t[2])
+                    if not all(r in summary for r in runs):
+                        continue
+                out.append(Record.createFromTuple(t, self))
+        out.sort(key = lambda r: r.epoch())
+        return out
+
+    # block that |recId| was created for, None if it isn't a valid id.
+    def blockOfId(self, recId):
+        date = Record.dateOfId(recId)
+        return blockNumber(date) if date != None else None
+
+    def _findInBlock(self, recId, block_number):
+        recs = self.loadBlock(block_number)
+        if recs == None:
+            return None
+        rec = recs.findById(recId)
+        if rec == None or rec.deleted():
+            return None
+        return rec
+
+    # The id tells which block the record is in, so normally only that
+    # block is read. Records stored elsewhere are found through the id
+    # index.
     def findById(self, recId):
-        for i in self._allFilesIterator():
-            recs = self._loadRecordsFromFile(i)
-            rec = recs.findById(recId)
+        block = self.blockOfId(recId)
+        if block != None:
+            rec = self._findInBlock(recId, block)
             if rec != None:
                 return rec
+        block = self._ids.blockOf(recId)
+        if block != None:
+            return self._findInBlock(recId, block)
         return None
 
+    # id -> live record for every id of |recIds| that has one. The ids are
+    # grouped by the block they name, so each block is read once; those
+    # that aren't there are looked up in the id index, grouped again.
+    def findByIds(self, recIds):
+        out = dict()
+        def collect(blockOf, recIds):
+            byBlock = dict()
+            for recId in recIds:
+                block = blockOf(recId)
+                if block != None:
+                    byBlock.setdefault(block, []).append(recId)
+            for block, ids in sorted(byBlock.items()):
+                pool = self._loadBlockTuples(block) or dict()
+                for recId in ids:
+                    t = pool.get(recId)
+                    if t != None:
+                        out[recId] = Record.createFromTuple(t, self)
+        recIds = set(recIds)
+        collect(self.blockOfId, recIds)
+        collect(self._ids.blockOf, recIds - out.keys())
+        return out
+
     def allType(self):
         return self._collectAll('types')
 
@@ -0,0 +1,155 @@
+from blockcache import decodeLines
+from record import Record
+from array import array
+import instrument
+import bisect, marshal, os
+
+# Time index of a jsonl block: the epoch, byte offset and length of the
+# line that holds the latest version of each live record, sorted by epoch,
+# and the ids of the records the file deletes. A query for a range that
+# covers only part of a block seeks to the lines in the range instead of
+# decoding the whole block.
+#
+# Lines are appended in any order and an id may have several of them, so
+# there is an entry per live record rather than one every so many lines.
+# Ids are kept joined by newlines, and only split when they are needed.
+# Like the block cache, the index is kept with the size and the last bytes
+# of the file it was made from: lines appended since are added when it is
+# next used, any other change builds it again.
+INDEX_VERSION = 1
+TAIL = 64
+
+# Decoding a line costs several times what loading a record from the block
+# cache does, so the index is only used for files of at least MIN_SIZE
+# bytes, and for ranges that hold at most 1/MAX_SHARE of their records.
+MIN_SIZE = 1 << 16
+MAX_SHARE = 4
+
+class TimeIndex:
+    def __init__(self, storage, dirname = "cache"):
+        self._storage = storage
+        self._dir = storage.pathname(dirname)
+
+    def _indexPath(self, fn):
+        return os.path.join(self._dir, os.path.basename(fn) + ".time")
+
+    def _read(self, fn):
+        try:
+            with open(self._indexPath(fn), "rb") as f:
+                entry = marshal.loads(f.read())
+        except (FileNotFoundError, EOFError, ValueError, TypeError):
+            return None
+        if not isinstance(entry, tuple) or len(entry) != 8 or \
+           entry[0] != INDEX_VERSION:
+            return None
+        return entry
+
+    def exists(self, fn):
+        return os.path.isfile(self._indexPath(fn))
+
+    def drop(self, fn):
+        try:
+            os.remove(self._indexPath(fn))
+        except FileNotFoundError:
+            pass
+
+    # The index of |fn|, None if there's no such file. It is brought up to
+    # date with the file, and saved if that changed it.
+    def load(self, fn):
+        try:
+            st = os.stat(fn)
+        except FileNotFoundError:
+            return None
+        with instrument.phase("timeindex.read"):
+            entry = self._read(fn)
+        with open(fn, "rb") as f:
+            if entry != None and entry[1] <= st.st_size:
+                f.seek(max(0, entry[1] - TAIL))
+                if f.read(entry[1] - max(0, entry[1] - TAIL)) != entry[2]:
+                    entry = None
+                elif entry[1] == st.st_size:
+                    return entry
+            else:
+                entry = None
+            offset = entry[1] if entry != None else 0
+            f.seek(offset)
+            data = f.read()
+
+        # a line without its newline may still be being written.
+        end = data.rfind(b"\n") + 1
+        if entry != None and end == 0:
+            return entry
+        entries = dict() # id -> (epoch, offset, length)
+        deleted = set()
+        tail = b""
+        if entry != None:
+            version, size, tail, ids, epochs, offsets, lengths, gone = entry
+            entries = { rId: e for rId, e in
+                        zip(_split(ids),
+                            zip(array("q", epochs), array("q", offsets),
+                                array("I", lengths))) }
+            deleted = set(_split(gone))
+        with instrument.phase("timeindex.update"):
+            decoded, bad = decodeLines(data[:end], offset)
+            for off, length, rec in decoded:
+                if rec.deleted():
+                    entries.pop(rec.rId(), None)
+                    deleted.add(rec.rId())
+                else:
+                    entries[rec.rId()] = (rec.epoch(), off, length)
+                    deleted.discard(rec.rId())
+            order = sorted(entries, key = lambda rId: entries[rId][:2])
+        entry = (INDEX_VERSION, offset + end, (tail + data[:end])[-TAIL:],
+                 "\n".join(order),
+                 array("q", (entries[i][0] for i in order)).tobytes(),
+                 array("q", (entries[i][1] for i in order)).tobytes(),
+                 array("I", (entries[i][2] for i in order)).tobytes(),
+                 "\n".join(sorted(deleted)))
+        with instrument.phase("timeindex.write"):
+            self._storage.writeAtomically(self._indexPath(fn),
+                                          marshal.dumps(entry))
+        return entry
+
+    # Tuples of the live records of |fn| from |start| to |end|, microseconds
+    # since 1970, and with |withIds|, the ids of every record in |fn|,
+    # deleted ones included, which replace those of the binary file of the
+    # block. None if there's no such file, or if the block cache is the
+    # cheaper way to read it, see MIN_SIZE.
+    def rangeTuples(self, fn, start, end, withIds = False):
+        try:
+            if os.path.getsize(fn) < MIN_SIZE:
+                return None
+        except FileNotFoundError:
+            return None
+        entry = self.load(fn)
+        if entry == None:
+            return None
+        version, size, tail, ids, epochs, offsets, lengths, deleted = entry
+        epochs = array("q", epochs)
+        lo = bisect.bisect_left(epochs, start)
+        hi = bisect.bisect_right(epochs, end)
+        if (hi - lo) * MAX_SHARE > len(epochs):
+            return None
+        known = None
+        if withIds:
+            known = set(_split(ids))
+            known.update(_split(deleted))
+        if lo == hi:
+            return [], known
+        offsets = array("q", offsets)
+        lengths = array("I", lengths)
+        rows = sorted(range(lo, hi), key = offsets.__getitem__)
+        first = offsets[rows[0]]
+        last = max(offsets[i] + lengths[i] for i in rows)
+        with instrument.phase("storage.read"), open(fn, "rb") as f:
+            f.seek(first)
+            data = f.read(last - first)
+        with instrument.phase("storage.decode_json"):
+            lines = [str(data[offsets[i] - first:
+                              offsets[i] - first + lengths[i]], "utf-8")
+                     for i in rows]
+            recs = Record.createFromJsonLines(lines, None)
+        return [r.toTuple() for r in recs], known
+
+def _split(ids):
+    return ids.split("\n") if ids != "" else []
@@ -1,4 +1,4 @@
-import re, datetime, os, readline
+import re, datetime, os, sys, readline, bisect
 import dateutil.tz
 
 def formatDate(date):
@@ -156,19 +156,50 @@ class TextInputHandler:
         readline.clear_history()
         return r
 
+# Hints kept sorted so that the ones starting with a prefix are found by
+# bisection. Matches are ranked by |usage|, a value -> (count, last used
+# timestamp) dictionary: most used first, then most recently used.
+class CompletionIndex:
+    def __init__(self, hints, usage = None):
+        usage = usage if usage != None else dict()
+        self._sorted = sorted(set(hints))
+        def rank(v):
+            count, last = usage.get(v, (0, 0))
+            return (-count, -last)
+        ranked = sorted(self._sorted, key = rank)
+        self._ranked = ranked
+        self._pos = { v: i for i, v in enumerate(ranked) }
+
+    def complete(self, txt, exclude = ()):
+        if txt == "":
+            matches = self._ranked
+        else:
+            lo = bisect.bisect_left(self._sorted, txt)
+            hi = bisect.bisect_left(self._sorted, txt + chr(sys.maxunicode),
+                                    lo)
+            matches = sorted(self._sorted[lo:hi], key = self._pos.get)
+        return [s for s in matches if not s in exclude]
+
 class HintedInputHandler(TextInputHandler):
+    # |hints| is a CompletionIndex or any iterable of strings.
     def __init__(self,
                  display,
                  hints,
                  default = None,
                  allowEmpty = False):
         super().__init__(display, default, allowEmpty)
-        self._hints = hints
+        self._index = hints if isinstance(hints, CompletionIndex) \
+            else CompletionIndex(hints)
+        self._exclude = set()
+
+    # hints that shouldn't be offered any more.
+    def exclude(self, values):
+        self._exclude = set(values)
 
     def comp(self, txt, state):
         if state == 0:
             # build list
-            self._comp_list = [s for s in self._hints if s[:len(txt)] == txt]
+            self._comp_list = self._index.complete(txt, self._exclude)
         return self._comp_list[state] if len(self._comp_list) > state else None
 
     def getInput(self):
@@ -188,13 +219,13 @@ class TagsInputHandler:
 
     def getInput(self):
         out = set(self._default)
-        initHints = set(self._hints)
+        handler = HintedInputHandler(self._display + " [- to delete, empty to end]",
+                                     self._hints,
+                                     allowEmpty = True)
         while True:
-            hints = initHints - out
+            handler.exclude(out)
             print("Current tag: [{}]".format(", ".join(out)))
-            inp = HintedInputHandler(self._display + " [- to delete, empty to end]",
-                                     hints,
-                                     allowEmpty = True).getInput()
+            inp = handler.getInput()
             if inp == "":
                 break
             if inp[0] == '-':
@@ -240,15 +271,18 @@ def getUserInput(csb,
     out["summary"] = TextInputHandler("Summary",
                                       originSummary).getInput()
     out["type"] = HintedInputHandler("Type",
-                                     csb.allType(),
+                                     CompletionIndex(csb.allType(),
+                                                     csb.usage("types")),
                                      originType).getInput()
     out["tags"] = TagsInputHandler("Tags",
-                                   csb.allTag(),
+                                   CompletionIndex(csb.allTag(),
+                                                   csb.usage("tags")),
                                    originTags).getInput()
     out["amount"] = AmountInputHandler("Amount",
                                        originAmount).getInput()
     out["currency"] = "NTD"
     out["payment"] = HintedInputHandler("Payment method",
-                                        csb.allPayment(),
+                                        CompletionIndex(csb.allPayment(),
+                                                        csb.usage("payments")),
                                         originPayment).getInput()
     return out